@@ -1,80 +1,329 @@
 from __future__ import annotations
 
 import argparse
-import json
+import hashlib
+import logging
+import os
+import shelve
+import stat
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
 
-from .config import load_config
-from .extract import simple_from_text, extract_from_path, extract_from_url
+from . import jsonio
+from .config import AppConfig, load_config
+from .extract import ExtractedBundle, simple_from_text, extract_from_path, extract_from_url
 from .llm import LLMClient
 from .render import render_note
 from .routing import route_and_fill
-from .settings import load_types_config, load_prompt
+from .settings import TypesConfig, load_types_config, load_prompt
 from .slugify import make_slug
 
 
-def process_entry(text_or_path: str, llm: LLMClient, output_root: Path | None) -> Path:
-    cfg = load_config()
-    # detect local file path
-    p = Path(text_or_path)
-    if str(text_or_path).startswith("http://") or str(text_or_path).startswith("https://"):
-        bundle = extract_from_url(str(text_or_path))
-    elif p.exists() and p.is_file():
-        bundle = extract_from_path(str(p))
-    else:
-        bundle = simple_from_text(text_or_path)
+# Decode budget for {"title": "<2-3 words>"}; Cyrillic words cost several tokens each
+NAMING_MAX_TOKENS = 24
+# Titles per batched naming call, and the output budget ceiling for one such call
+NAMING_BATCH_SIZE = 40
+NAMING_BATCH_MAX_TOKENS = 8192
+
+
+class RouteCache:
+    """Persistent stage1 results keyed by entry text and a config fingerprint.
+
+    Some dbm backends are bound to the opening thread, so only use it from main.
+    """
+
+    def __init__(self, cache_dir: Path, fingerprint: str):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._db = shelve.open(str(cache_dir / "batch_routes"))
+        self._fingerprint = fingerprint
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self._fingerprint}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> dict[str, Any] | None:
+        routed = self._db.get(self._key(text))
+        if routed is not None:
+            # Entries cached before 'created' was stripped; render stamps today's date instead
+            routed.pop("created", None)
+        return routed
+
+    def put(self, text: str, routed: dict[str, Any]) -> None:
+        # 'created' is the routing day, not part of the route: a rerun must not reuse it
+        self._db[self._key(text)] = {k: v for k, v in routed.items() if k != "created"}
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def config_fingerprint(cfg: AppConfig) -> str:
+    # Any edit to types/enums/routing prompt (or switching to a real LLM) invalidates cached routes
+    parts = [str(cfg.agent_config_path), "llm" if cfg.deepseek_api_key else "fallback"]
+    for rel in ("types.yaml", "enums.yaml", "prompts/routing.txt"):
+        p = cfg.agent_config_path / rel
+        parts.append(f"{rel}:{p.stat().st_mtime_ns if p.exists() else 0}")
+    return "|".join(parts)
+
+
+def detect_bundle(text_or_path: str) -> ExtractedBundle:
+    if text_or_path.startswith(("http://", "https://")):
+        return extract_from_url(text_or_path)
+    # detect local file path with a single stat (long free text may raise ENAMETOOLONG)
+    try:
+        is_file = stat.S_ISREG(os.stat(text_or_path).st_mode)
+    except (OSError, ValueError):
+        is_file = False
+    if is_file:
+        return extract_from_path(text_or_path)
+    return simple_from_text(text_or_path)
+
+
+def unique_lines(lines: Iterable[str]) -> Iterator[str]:
+    # Order-preserving dedup that still yields lazily, so fetching starts on the first line
+    seen: set[str] = set()
+    for ln in lines:
+        ln = ln.strip()
+        if ln and ln not in seen:
+            seen.add(ln)
+            yield ln
+
+
+def route_bundle(bundle: ExtractedBundle, llm: LLMClient) -> dict[str, Any]:
     routed = route_and_fill(llm, bundle.to_summary(), source_hint="batch")
+    routed.setdefault("raw_text", bundle.raw_text)
+    return routed
+
+
+def stage1_route(text_or_path: str, llm: LLMClient) -> dict[str, Any]:
+    return route_bundle(detect_bundle(text_or_path), llm)
+
+
+def route_all(
+    lines: Iterable[str],
+    llm: LLMClient,
+    cache: RouteCache | None,
+    fetch_workers: int,
+    llm_workers: int,
+) -> list[dict[str, Any]]:
+    """Two-stage stage1: extraction and LLM routing run on separately sized pools.
+
+    An entry is handed to the LLM pool as soon as its fetch completes, so slow
+    downloads overlap with routing of the entries that are already extracted.
+    Each route is cached the moment it finishes; entries whose fetch or route
+    fails are logged and left out of the result instead of aborting the run.
+    At most a small window of entries is in flight, so lines are read only as
+    workers free up; the returned routes themselves are still one per entry.
+    """
+    log = logging.getLogger("kb.batch")
+    max_in_flight = 2 * (fetch_workers + llm_workers)
+    routed_list: list[dict[str, Any] | None] = []
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, ThreadPoolExecutor(max_workers=llm_workers) as llm_pool:
+        # fetch and route futures alike, mapped to (entry index, entry text)
+        pending: dict[Future, tuple[int, str]] = {}
+
+        def settle(done: Iterable[Future]) -> None:
+            for fut in done:
+                i, text = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    log.warning("batch entry skipped (%s): %.80s", e, text)
+                    continue
+                if isinstance(result, ExtractedBundle):
+                    pending[llm_pool.submit(route_bundle, result, llm)] = (i, text)
+                    continue
+                routed_list[i] = result
+                if cache is not None:
+                    cache.put(text, result)
 
-    # Naming step to compress title
+        for ln in lines:
+            cached = cache.get(ln) if cache is not None else None
+            if cached is None:
+                # Backpressure: stop reading until an in-flight entry settles
+                while len(pending) >= max_in_flight:
+                    settle(wait(pending, return_when=FIRST_COMPLETED)[0])
+                pending[fetch_pool.submit(detect_bundle, ln)] = (len(routed_list), ln)
+            routed_list.append(cached)
+        while pending:
+            settle(wait(pending, return_when=FIRST_COMPLETED)[0])
+    return [r for r in routed_list if r is not None]
+
+
+def _short_title(title: Any) -> str | None:
+    if not isinstance(title, str) or not title.strip():
+        return None
+    words = title.strip().split()
+    return " ".join(words[:3])
+
+
+def needs_naming(routed: dict[str, Any]) -> bool:
+    # Titles that already fit in 3 words (or entries without text) are kept as routed
+    title = routed.get("title")
+    if not isinstance(title, str) or len(title.split()) <= 3:
+        return False
+    return bool((routed.get("raw_text") or "").strip())
+
+
+def name_single(llm: LLMClient, naming_system: str, routed: dict[str, Any]) -> str | None:
+    if not needs_naming(routed):
+        return None
     try:
-        naming_system = load_prompt(cfg.agent_config_path, "naming")
-        naming_input = json.dumps({"type": routed.get("type"), "title": routed.get("title")}, ensure_ascii=False)
-        named = llm.chat_json(naming_system, naming_input).content or {}
-        new_title = named.get("title") or routed.get("title")
-        if isinstance(new_title, str):
-            words = new_title.strip().split()
-            if len(words) > 3:
-                new_title = " ".join(words[:3])
-            routed["title"] = new_title
+        naming_input = jsonio.dumps({"type": routed.get("type"), "title": routed.get("title")})
+        named = llm.chat_json(naming_system, naming_input, temperature=0, max_tokens=NAMING_MAX_TOKENS).content or {}
+        return _short_title(named.get("title"))
     except Exception:
-        pass
+        return None
+
+
+def _name_chunk(
+    llm: LLMClient,
+    batch_system: str,
+    routed_list: list[dict[str, Any]],
+    chunk: list[int],
+) -> dict[int, str | None]:
+    items = [{"i": i, "type": routed_list[i].get("type"), "title": routed_list[i].get("title")} for i in chunk]
+    named = llm.chat_json(
+        batch_system,
+        jsonio.dumps({"items": items}),
+        temperature=0,
+        max_tokens=min(NAMING_BATCH_MAX_TOKENS, 16 + (NAMING_MAX_TOKENS + 8) * len(items)),
+    ).content or {}
+    wanted = set(chunk)
+    titles: dict[int, str | None] = {}
+    for item in named.get("items") or []:
+        i = item.get("i") if isinstance(item, dict) else None
+        if isinstance(i, int) and i in wanted:
+            titles[i] = _short_title(item.get("title"))
+    return titles
+
+
+def name_batch(
+    llm: LLMClient,
+    naming_system: str,
+    batch_system: str,
+    routed_list: list[dict[str, Any]],
+    workers: int = 8,
+) -> list[str | None]:
+    """Shorten long titles with bounded naming calls; per-item calls if a batch answer is unusable.
+
+    Returns None for entries whose routed title is kept as is.
+    """
+    titles: list[str | None] = [None] * len(routed_list)
+    todo = [i for i, r in enumerate(routed_list) if needs_naming(r)]
+    if not todo:
+        return titles
+    # Sub-batches keep each answer well under the provider's output-token cap
+    chunks = [todo[k:k + NAMING_BATCH_SIZE] for k in range(0, len(todo), NAMING_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(_name_chunk, llm, batch_system, routed_list, chunk) for chunk in chunks]
+        for fut in futures:
+            try:
+                for i, title in fut.result().items():
+                    titles[i] = title
+            except Exception:
+                logging.getLogger("kb.batch").warning("batch naming failed, falling back to per-item naming")
+        missing = [i for i in todo if titles[i] is None]
+        for i, title in zip(missing, pool.map(lambda i: name_single(llm, naming_system, routed_list[i]), missing)):
+            titles[i] = title
+    return titles
+
+
+def notes_root_for(cfg: AppConfig, output_root: Path | None) -> Path:
+    # dry-run writes under output_root, otherwise into the vault
+    return output_root if output_root is not None else cfg.vault_path / "700_База_Данных"
+
 
-    routed.setdefault("raw_text", raw_text)
-    rendered = render_note(cfg.templates_path, routed)
+class NoteFolders:
+    """Type → note directory map computed once per batch."""
 
-    if output_root is None:
-        # write into vault
-        types_cfg = load_types_config(cfg.agent_config_path)
-        folder = types_cfg.dir_for(routed["type"])
-        note_dir = cfg.vault_path / "700_База_Данных" / folder
+    def __init__(self, types_cfg: TypesConfig, notes_root: Path):
+        self._types_cfg = types_cfg
+        self._notes_root = notes_root
+        self._by_type = {t: notes_root / types_cfg.dir_for(t) for t in types_cfg.types}
+
+    def dir_for(self, type_name: str) -> Path:
+        note_dir = self._by_type.get(type_name)
+        if note_dir is None:
+            note_dir = self._by_type.setdefault(type_name, self._notes_root / self._types_cfg.dir_for(type_name))
+        return note_dir
+
+
+def stage2_render(
+    routed: dict[str, Any],
+    templates_dir: Path,
+    folders: NoteFolders,
+    new_title: str | None = None,
+) -> tuple[Path, bytes]:
+    # Without a usable naming reply the routed title is still cut to 3 words, as before batching
+    title = new_title or _short_title(routed.get("title"))
+    if title:
+        routed["title"] = title
+    rendered = render_note(templates_dir, routed)
+    note_path = folders.dir_for(routed["type"]) / f"{make_slug(routed['title'])}.md"
+    return note_path, rendered.encode("utf-8")
+
+
+def _write_target(target: tuple[Path, bytes]) -> int:
+    note_path, data = target
+    return note_path.write_bytes(data)
+
+
+def write_notes(targets: list[tuple[Path, bytes]], io_workers: int = 4) -> list[Path]:
+    # One write per path, last target wins as with sequential writes; concurrent writes
+    # to the same file could interleave two bodies
+    by_path = dict(targets)
+    # Create each distinct folder once, then write without interleaved mkdirs
+    for note_dir in {p.parent for p in by_path}:
+        note_dir.mkdir(parents=True, exist_ok=True)
+    if len(by_path) > 1 and io_workers > 1:
+        with ThreadPoolExecutor(max_workers=io_workers) as io_pool:
+            list(io_pool.map(_write_target, by_path.items()))
     else:
-        types_cfg = load_types_config(cfg.agent_config_path)
-        folder = types_cfg.dir_for(routed["type"])
-        note_dir = output_root / folder
-    note_dir.mkdir(parents=True, exist_ok=True)
-    note_path = note_dir / f"{make_slug(routed['title'])}.md"
-    note_path.write_text(rendered, encoding="utf-8")
-    return note_path
+        for target in by_path.items():
+            _write_target(target)
+    return [p for p, _ in targets]
+
+
+def process_entry(text_or_path: str, llm: LLMClient, output_root: Path | None) -> Path:
+    cfg = load_config()
+    types_cfg = load_types_config(cfg.agent_config_path)
+    naming_system = load_prompt(cfg.agent_config_path, "naming")
+    routed = stage1_route(text_or_path, llm)
+    new_title = name_single(llm, naming_system, routed)
+    folders = NoteFolders(types_cfg, notes_root_for(cfg, output_root))
+    return write_notes([stage2_render(routed, cfg.templates_path, folders, new_title)])[0]
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Batch ingest test for knowledge bot")
     parser.add_argument("input_file", type=Path, help="Text file with one entry per line (text, URL or local path)")
     parser.add_argument("--dry-output", type=Path, default=None, help="If set, write notes under this directory instead of Vault")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the persistent routing cache")
     args = parser.parse_args()
 
     cfg = load_config()
+    types_cfg = load_types_config(cfg.agent_config_path)
+    naming_system = load_prompt(cfg.agent_config_path, "naming")
+    batch_system = load_prompt(cfg.agent_config_path, "naming_batch")
+    templates_dir = cfg.templates_path
+    folders = NoteFolders(types_cfg, notes_root_for(cfg, args.dry_output))
     llm = LLMClient(cfg.deepseek_api_key, cfg.deepseek_base_url)
+    cache = None if args.no_cache else RouteCache(cfg.cache_dir, config_fingerprint(cfg))
 
-    lines = [ln.strip() for ln in args.input_file.read_text(encoding="utf-8").splitlines() if ln.strip()]
-    out_paths: list[Path] = []
-    for ln in lines:
-        out_paths.append(process_entry(ln, llm, args.dry_output))
+    try:
+        with args.input_file.open("r", encoding="utf-8", buffering=128 * 1024) as fh:
+            # Entries are submitted as they are read, so fetching starts before the file is consumed
+            routed_list = route_all(unique_lines(fh), llm, cache, cfg.batch_fetch_concurrency or 32, cfg.batch_concurrency or 8)
+    finally:
+        # Routes are cached as they finish; closing here keeps them on disk if the run is interrupted
+        if cache is not None:
+            cache.close()
+    titles = name_batch(llm, naming_system, batch_system, routed_list, cfg.batch_concurrency or 8)
+    targets = [stage2_render(r, templates_dir, folders, t) for r, t in zip(routed_list, titles)]
+    out_paths = write_notes(targets)
 
-    print("Created:")
-    for p in out_paths:
-        print("-", p)
+    sys.stdout.write("Created:\n" + "".join(f"- {p}\n" for p in out_paths))
 
 
 if __name__ == "__main__":
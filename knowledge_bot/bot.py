@@ -1,29 +1,88 @@
 from __future__ import annotations
 
 import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from .config import load_config
+from . import jsonio
+from .config import AppConfig, load_config
 from .extract import simple_from_text, extract_from_path
 from .schema import allowed_fields_for_type
-from .settings import load_prompt, load_enums_config
-from .llm import LLMClient
-from .persist import write_note, save_raw_file
+from .settings import EnumsConfig, load_prompt, load_enums_config
+from .llm import LLMClient, get_llm
+from .paths import vault_relative
+from .persist import write_note, temp_raw_path, move_raw_file
 from .render import render_note
-from .routing import route_and_fill
+from .routing import route_and_fill, reclassify_with_asr
+from .slugify import slug_ascii
 from .logging_setup import init_logging
 import logging
-import requests
-import json
 
 
-_PENDING: dict[int, dict[str, Any]] = {}
+class _PendingPreviews:
+    """Per-user previews awaiting Save/Cancel; abandoned ones expire or get evicted."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items: OrderedDict[int, tuple[float, dict[str, Any]]] = OrderedDict()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._items:
+            _, (stamp, _) = next(iter(self._items.items()))
+            if now - stamp < self._ttl:
+                break
+            self._items.popitem(last=False)
+
+    def __setitem__(self, user_id: int, state: dict[str, Any]) -> None:
+        self._items.pop(user_id, None)
+        self._items[user_id] = (time.monotonic(), state)
+        self._expire()
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, user_id: int) -> dict[str, Any] | None:
+        self._expire()
+        entry = self._items.get(user_id)
+        return entry[1] if entry else None
+
+    def pop(self, user_id: int, default: Any = None) -> Any:
+        self._expire()
+        entry = self._items.pop(user_id, None)
+        return entry[1] if entry else default
+
+
+_PENDING = _PendingPreviews()
+
+_URL_RE = re.compile(r"https?://[^\s)]+")
+_URL_TRIM = ".,);]'\""
+_MEDIA_KINDS = ("document", "photo", "video", "video_note", "audio", "voice")
+# Payload keys that never inform tags
+_TAG_EXCLUDE = frozenset({"type", "title", "created", "tags", "attachments", "source", "form", "raw_text", "raw_dir"})
+# Longer field values (transcripts, extracted text) already reach the tags prompt via the summary
+_TAG_FIELD_MAX_CHARS = 2048
+# PDF/OCR/ASR extraction pool, created in main(); None falls back to the loop's default executor
+_EXTRACT_POOL: ThreadPoolExecutor | None = None
+# Transcript head used for the type re-check when the ASR summary is unavailable
+_ASR_RECLASSIFY_CHARS = 2000
+
+
+def _normalize_url(u: str) -> str:
+    return u.strip().strip(_URL_TRIM)
 
 
 def _preview_keyboard() -> InlineKeyboardBuilder:
@@ -35,215 +94,367 @@ def _preview_keyboard() -> InlineKeyboardBuilder:
     return kb
 
 
+@lru_cache(maxsize=None)
+def _enums_prefix(config_dir: Path, with_synonyms: bool = False) -> str:
+    # Serialized once: identical bytes on every call keep the provider's prompt-prefix cache hot
+    enums_cfg = load_enums_config(config_dir)
+    parts = ['"enums": ' + jsonio.dumps(enums_cfg.prompt_payload())]
+    if with_synonyms:
+        parts.append('"synonyms": ' + jsonio.dumps(enums_cfg.synonyms))
+    return ", ".join(parts)
+
+
+def _fields_for_tags(payload: dict[str, Any]) -> dict[str, Any]:
+    fields: dict[str, Any] = {}
+    for k, v in payload.items():
+        if k in _TAG_EXCLUDE:
+            continue
+        if len(v if isinstance(v, str) else jsonio.dumps(v)) > _TAG_FIELD_MAX_CHARS:
+            continue
+        fields[k] = v
+    return fields
+
+
+def _finalize_tags(enums_cfg: EnumsConfig, type_name: str | None, tag_values: list[str]) -> list[str]:
+    # Controlled namespaces keep only enum values; result is deduplicated and sorted
+    allowed = set()
+    for tag in tag_values:
+        ns, _, value = tag.partition("/")
+        if enums_cfg.allows_tag(type_name, ns, value):
+            allowed.add(tag)
+    return sorted(allowed)
+
+
+def _json_with_prefix(prefix: str, tail: dict[str, Any]) -> str:
+    """JSON object whose static members (``prefix``) come before the per-message ones."""
+    return "{" + prefix + ", " + jsonio.dumps(tail)[1:]
+
+
+async def _llm_json(llm: LLMClient, system_prompt: str, user_prompt: str) -> Any:
+    # chat_json is a blocking HTTP call; keep the event loop free for other updates
+    return (await asyncio.to_thread(llm.chat_json, system_prompt, user_prompt)).content
+
+
+def _suggest_title(
+    llm: LLMClient,
+    cfg: AppConfig,
+    type_name: str | None,
+    summary: dict[str, Any],
+    filenames: list[str],
+    hint_title: str | None,
+) -> str | None:
+    # Naming: use summary context for robust 2–3 word title
+    try:
+        naming_system = load_prompt(cfg.agent_config_path, "naming")
+        naming_input = jsonio.dumps({
+            "type": type_name,
+            "summary": summary,
+            "filenames": filenames,
+            "hint_title": hint_title
+        })
+        named = llm.chat_json(naming_system, naming_input).content or {}
+        if isinstance(named.get("title"), str) and named["title"].strip():
+            return named["title"].strip()
+    except Exception:
+        pass
+    return None
+
+
+def _fill_fields(
+    llm: LLMClient,
+    cfg: AppConfig,
+    type_name: str,
+    summary: dict[str, Any],
+    filenames: list[str],
+) -> dict[str, Any]:
+    # Field fill: restrict to template fields
+    try:
+        allowed_fields = allowed_fields_for_type(type_name) or []
+        field_system = load_prompt(cfg.agent_config_path, "field_fill")
+        user = _json_with_prefix(_enums_prefix(cfg.agent_config_path), {
+            "type": type_name,
+            "allowed_fields": allowed_fields,
+            "summary": summary,
+            "filenames": filenames,
+        })
+        filled = llm.chat_json(field_system, user).content or {}
+        return {k: filled[k] for k in allowed_fields if k in filled}
+    except Exception as e:
+        logging.getLogger("kb.bot").warning("field_fill failed: %s", e)
+        return {}
+
+
+def _tag_candidates(resp: Any) -> list[Any]:
+    if isinstance(resp, dict):
+        return resp.get("tags") or []
+    return resp if isinstance(resp, list) else []
+
+
+def _normalize_tags(enums_cfg: EnumsConfig, type_name: str | None, candidates: list[Any]) -> list[str]:
+    # Normalize tags to all-English ASCII slugs (free namespaces), lower-case namespaces
+    tag_values = []
+    for tag in candidates:
+        if isinstance(tag, str) and "/" in tag:
+            ns, _, val = tag.strip().partition("/")
+            ns = (ns or "").strip().lower()
+            raw_val = (val or "").strip()
+            # apply synonyms if provided for namespace (exact match, case-insensitive)
+            syn_map = enums_cfg.synonyms.get(ns, {})
+            mapped = syn_map.get(raw_val.lower())
+            if mapped:
+                raw_val = mapped
+            # candidate ascii slug
+            cand_slug = slug_ascii(raw_val)
+            # if namespace is controlled (per config), try to map to allowed canonical values
+            is_controlled = ns in enums_cfg.namespaces_controlled
+            if is_controlled and enums_cfg.allowed_values(type_name, ns):
+                chosen = enums_cfg.canonical_value(type_name, ns, cand_slug)
+                # no good match -> skip to avoid non-canonical values
+                if chosen:
+                    tag_values.append(f"{ns}/{chosen}")
+            elif ns and cand_slug:
+                # free namespace
+                tag_values.append(f"{ns}/{cand_slug}")
+    return tag_values
+
+
+def _combined_fill(
+    llm: LLMClient,
+    cfg: AppConfig,
+    type_name: str,
+    summary: dict[str, Any],
+    filenames: list[str],
+    links: list[str],
+    hint_title: str | None,
+) -> tuple[str | None, dict[str, Any], list[Any]] | None:
+    # Title, fields and tags in one request; None (no usable "fields") sends callers to the staged prompts
+    try:
+        allowed_fields = allowed_fields_for_type(type_name) or []
+        system = load_prompt(cfg.agent_config_path, "combined_fill")
+        user = _json_with_prefix(_enums_prefix(cfg.agent_config_path, with_synonyms=True), {
+            "type": type_name,
+            "allowed_fields": allowed_fields,
+            "summary": summary,
+            "attachments": {"links": links},
+            "filenames": filenames,
+            "hint_title": hint_title,
+        })
+        resp = llm.chat_json(system, user).content
+    except Exception as e:
+        logging.getLogger("kb.bot").warning("combined_fill failed: %s", e)
+        return None
+    if not isinstance(resp, dict) or not isinstance(resp.get("fields"), dict):
+        return None
+    title = resp.get("title")
+    title = title.strip() if isinstance(title, str) and title.strip() else None
+    fields = {k: resp["fields"][k] for k in allowed_fields if k in resp["fields"]}
+    return title, fields, _tag_candidates(resp)
+
+
+def _staged_tag_candidates(
+    llm: LLMClient,
+    cfg: AppConfig,
+    summary: dict[str, Any],
+    payload: dict[str, Any],
+) -> list[Any]:
+    # Tags step: generate from type, summary, attachments, enums, and filled fields
+    tags_system = load_prompt(cfg.agent_config_path, "tags")
+    tags_user = _json_with_prefix(_enums_prefix(cfg.agent_config_path, with_synonyms=True), {
+        "type": payload.get("type"),
+        "summary": summary,
+        "attachments": {"links": payload.get("attachments", {}).get("links", [])},
+        "filenames": payload.get("filenames", []),
+        "fields": _fields_for_tags(payload),
+    })
+    return _tag_candidates(llm.chat_json(tags_system, tags_user).content)
+
+
+async def _complete_payload(
+    llm: LLMClient,
+    cfg: AppConfig,
+    enums_cfg: EnumsConfig,
+    payload: dict[str, Any],
+    summary: dict[str, Any],
+) -> None:
+    """Fill title, template fields and tags of ``payload`` for its current type, in place."""
+    type_name = payload["type"]
+    filenames = payload.get("filenames", [])
+    links = payload.get("attachments", {}).get("links", [])
+    combined = await asyncio.to_thread(
+        _combined_fill, llm, cfg, type_name, summary, filenames, links, payload.get("title")
+    )
+    if combined is not None:
+        named_title, filled, candidates = combined
+    else:
+        # Staged fallback: naming and field fill run concurrently,
+        # tags go second because they use the filled fields
+        named_title, filled = await asyncio.gather(
+            asyncio.to_thread(_suggest_title, llm, cfg, type_name, summary, filenames, payload.get("title")),
+            asyncio.to_thread(_fill_fields, llm, cfg, type_name, summary, filenames),
+        )
+    if named_title:
+        payload["title"] = named_title
+    payload.update(filled)
+    if combined is None:
+        try:
+            candidates = await asyncio.to_thread(_staged_tag_candidates, llm, cfg, summary, payload)
+        except Exception as e:
+            logging.getLogger("kb.bot").warning("tags generation failed: %s", e)
+            payload.setdefault("tags", [])
+            return
+    payload["tags"] = _finalize_tags(enums_cfg, type_name, _normalize_tags(enums_cfg, type_name, candidates))
+
+
+async def _download_tg(bot: Bot, file_id: str, destination: Path, timeout: int) -> str | None:
+    # Streams through the bot's aiohttp session straight to disk: no event-loop blocking, O(chunk) memory
+    file = await bot.get_file(file_id)
+    file_path = getattr(file, "file_path", None)
+    if not file_path:
+        return None
+    await bot.download_file(file_path, destination=destination, timeout=timeout)
+    return file_path
+
+
+async def _ingest_attachment(
+    message: Message,
+    cfg: AppConfig,
+    routed: dict[str, Any],
+    summary_obj: dict[str, Any],
+    media: Any,
+    *,
+    form: str | None,
+    derived_field: str | None,
+    timeout: int,
+) -> Path | None:
+    # Download a Telegram media item into Export, link it from the note and harvest derived text
+    log = logging.getLogger("kb.bot")
+    tmp = await asyncio.to_thread(temp_raw_path, cfg.export_root)
+    try:
+        file_path = await _download_tg(message.bot, media.file_id, tmp, timeout=timeout)
+        if not file_path:
+            return None
+        name = getattr(media, "file_name", None) or file_path.split("/")[-1]
+        saved = await asyncio.to_thread(move_raw_file, cfg.export_root, name, tmp)
+    finally:
+        tmp.unlink(missing_ok=True)
+    log.info("Saved %s: %s (%d bytes)", form or "attachment", saved, saved.stat().st_size)
+    if not isinstance(routed.get("attachments"), dict):
+        routed["attachments"] = {"links": [], "files": []}
+    routed["attachments"].setdefault("links", [])
+    routed["attachments"].setdefault("files", [])
+    shown = vault_relative(cfg.vault_path, saved) or saved
+    routed["attachments"]["files"].append(str(shown))
+    routed["raw_dir"] = str(shown.parent)
+    # form=None keeps the routed form (photos are supplementary)
+    if form:
+        routed["form"] = form
+        routed.setdefault("filenames", []).append(name)
+    if derived_field:
+        try:
+            loop = asyncio.get_running_loop()
+            derived = await loop.run_in_executor(_EXTRACT_POOL, extract_from_path, str(saved))
+            value = getattr(derived, derived_field, None)
+            if value:
+                summary_obj["derived"][derived_field] = value
+        except Exception as e:
+            log.warning("%s extract failed: %s", derived_field, e)
+    return saved
+
+
+async def _access_middleware(
+    handler: Callable[[Message, dict[str, Any]], Awaitable[Any]],
+    message: Message,
+    data: dict[str, Any],
+) -> Any:
+    # Outer middleware: strangers are turned away before filter matching or any handler work
+    allowed_id = load_config().telegram_user_id
+    if allowed_id and message.from_user and message.from_user.id != allowed_id:
+        await message.answer("⛔️ Доступ запрещён")
+        return None
+    return await handler(message, data)
+
+
 async def handle_message(message: Message) -> None:
     log = logging.getLogger("kb.bot")
     cfg = load_config()
-    if cfg.telegram_user_id and message.from_user and message.from_user.id != cfg.telegram_user_id:
-        await message.answer("⛔️ Доступ запрещён")
-        return
 
     text = message.text or message.caption or ""
     if text.strip().startswith('/'):
         await message.answer("Я принимаю текст/ссылки/медиа и предлагаю сохранить как заметку.")
         return
+    if not text.strip() and not any(getattr(message, k, None) for k in _MEDIA_KINDS):
+        # Nothing to route: no text and no media, so no LLM calls either
+        await message.answer("Пусто")
+        return
     log.info("Incoming message len=%d", len(text))
+    enums_cfg = load_enums_config(cfg.agent_config_path)
     bundle = simple_from_text(text)
 
-    llm = LLMClient(cfg.deepseek_api_key, cfg.deepseek_base_url)
+    llm = get_llm()
     summary_obj = bundle.to_summary()
-    routed = route_and_fill(llm, summary_obj, source_hint="telegram")
+    routed = await asyncio.to_thread(route_and_fill, llm, summary_obj, source_hint="telegram")
     log.info("Routed type=%s title=%s", routed.get("type"), routed.get("title"))
-    # If there is a Telegram document, download and save to Export, link from note
-    try:
-        doc = getattr(message, "document", None)
-        if doc and cfg.telegram_bot_token:
-            file = await message.bot.get_file(doc.file_id)
-            file_path = getattr(file, "file_path", None)
-            if file_path:
-                url = f"{cfg.telegram_api_base}/file/bot{cfg.telegram_bot_token}/{file_path}"
-                resp = requests.get(url, timeout=120)
-                resp.raise_for_status()
-                content = resp.content
-                name = doc.file_name or file_path.split("/")[-1]
-                saved = save_raw_file(cfg.export_root, name, content)
-                log.info("Saved document: %s (%d bytes)", saved, len(content))
-                if not isinstance(routed.get("attachments"), dict):
-                    routed["attachments"] = {"links": [], "files": []}
-                routed["attachments"].setdefault("links", [])
-                routed["attachments"].setdefault("files", [])
-                try:
-                    rel = saved.relative_to(cfg.vault_path)
-                    routed["attachments"]["files"].append(str(rel))
-                    routed["raw_dir"] = str(rel.parent)
-                except Exception:
-                    routed["attachments"]["files"].append(str(saved))
-                    routed["raw_dir"] = str(saved.parent)
-                routed["form"] = "file"
-                routed.setdefault("filenames", []).append(name)
-                # enrich summary with derived text (pdf)
-                try:
-                    derived = extract_from_path(str(saved))
-                    if derived.pdf_text:
-                        summary_obj["derived"]["pdf_text"] = derived.pdf_text
-                except Exception as ee:
-                    log.warning("pdf extract failed: %s", ee)
-    except Exception as e:
-        log.warning("failed to download/save document: %s", e)
-        # provide filename hint if present
+    # Telegram media: save to Export, link from note and enrich the summary with derived text
+    media_jobs: list[tuple[Any, str | None, str | None, int]] = []
+    if cfg.telegram_bot_token:
+        if message.document:
+            media_jobs.append((message.document, "file", "pdf_text", 120))
+        if message.photo:
+            media_jobs.append((message.photo[-1], None, "ocr_text", 120))
+        vid = message.video or message.video_note
+        if vid:
+            media_jobs.append((vid, "video", "asr_text", 600))
+    for media, form, derived_field, timeout in media_jobs:
         try:
-            doc = getattr(message, "document", None)
-            if doc and getattr(doc, "file_name", None):
-                routed.setdefault("filenames", []).append(doc.file_name)
+            await _ingest_attachment(
+                message, cfg, routed, summary_obj, media,
+                form=form, derived_field=derived_field, timeout=timeout,
+            )
+        except Exception as e:
+            log.warning("failed to download/save %s: %s", form or "photo", e)
+            # provide filename hint if present
+            if form == "file" and getattr(media, "file_name", None):
+                routed.setdefault("filenames", []).append(media.file_name)
                 routed.setdefault("form", "file")
-        except Exception:
-            pass
-    # If there is a Telegram photo, download best size and save to Export; embed later in render
-    try:
-        photos = getattr(message, "photo", None)
-        if photos and cfg.telegram_bot_token:
-            best = photos[-1]
-            file = await message.bot.get_file(best.file_id)
-            file_path = getattr(file, "file_path", None)
-            if file_path:
-                url = f"{cfg.telegram_api_base}/file/bot{cfg.telegram_bot_token}/{file_path}"
-                resp = requests.get(url, timeout=120)
-                resp.raise_for_status()
-                content = resp.content
-                # Derive a filename
-                name = file_path.split("/")[-1]
-                saved = save_raw_file(cfg.export_root, name, content)
-                log.info("Saved photo: %s (%d bytes)", saved, len(content))
-                if not isinstance(routed.get("attachments"), dict):
-                    routed["attachments"] = {"links": [], "files": []}
-                routed["attachments"].setdefault("links", [])
-                routed["attachments"].setdefault("files", [])
-                try:
-                    rel = saved.relative_to(cfg.vault_path)
-                    routed["attachments"]["files"].append(str(rel))
-                    routed["raw_dir"] = str(rel.parent)
-                except Exception:
-                    routed["attachments"]["files"].append(str(saved))
-                    routed["raw_dir"] = str(saved.parent)
-                # keep form as-is; photo is supplementary
-                try:
-                    derived = extract_from_path(str(saved))
-                    if derived.ocr_text:
-                        summary_obj["derived"]["ocr_text"] = derived.ocr_text
-                except Exception as ee:
-                    log.warning("ocr extract failed: %s", ee)
-    except Exception as e:
-        log.warning("failed to download/save photo: %s", e)
-    # If there is a Telegram video, download, save to Export and run ASR
-    try:
-        vid = getattr(message, "video", None) or getattr(message, "video_note", None)
-        if vid and cfg.telegram_bot_token:
-            file = await message.bot.get_file(vid.file_id)
-            file_path = getattr(file, "file_path", None)
-            if file_path:
-                url = f"{cfg.telegram_api_base}/file/bot{cfg.telegram_bot_token}/{file_path}"
-                resp = requests.get(url, timeout=600)
-                resp.raise_for_status()
-                content = resp.content
-                name = (getattr(vid, "file_name", None) or file_path.split("/")[-1])
-                saved = save_raw_file(cfg.export_root, name, content)
-                log.info("Saved video: %s (%d bytes)", saved, len(content))
-                if not isinstance(routed.get("attachments"), dict):
-                    routed["attachments"] = {"links": [], "files": []}
-                routed["attachments"].setdefault("links", [])
-                routed["attachments"].setdefault("files", [])
-                try:
-                    rel = saved.relative_to(cfg.vault_path)
-                    routed["attachments"]["files"].append(str(rel))
-                    routed["raw_dir"] = str(rel.parent)
-                except Exception:
-                    routed["attachments"]["files"].append(str(saved))
-                    routed["raw_dir"] = str(saved.parent)
-                routed["form"] = "video"
-                routed.setdefault("filenames", []).append(name)
-                try:
-                    log.info("ASR begin for %s", saved)
-                    derived = await asyncio.to_thread(extract_from_path, str(saved))
-                    if derived.asr_text:
-                        summary_obj["derived"]["asr_text"] = derived.asr_text
-                        log.info("ASR captured len=%d", len(derived.asr_text))
-                        try:
-                            log.info("ASR text: %s", (derived.asr_text or "").strip()[:500])
-                        except Exception:
-                            pass
-                        # Re-route based on ASR text (content-driven)
-                        try:
-                            rerouted = route_and_fill(llm, summary_obj, source_hint="telegram")
-                            # Merge existing attachments/files/filenames/raw_dir/form
-                            rerouted.setdefault("attachments", {"links": [], "files": []})
-                            routed.setdefault("attachments", {"links": [], "files": []})
-                            # union links
-                            old_links = set(routed["attachments"].get("links", []) or [])
-                            new_links = set(rerouted["attachments"].get("links", []) or [])
-                            rerouted["attachments"]["links"] = sorted(old_links | new_links)
-                            # concat files preserving order
-                            old_files = routed["attachments"].get("files", []) or []
-                            new_files = rerouted["attachments"].get("files", []) or []
-                            rerouted["attachments"]["files"] = new_files + [f for f in old_files if f not in new_files]
-                            # preserve filenames/raw_dir/form
-                            if routed.get("filenames"):
-                                rerouted.setdefault("filenames", []).extend([n for n in routed["filenames"] if n not in (rerouted.get("filenames") or [])])
-                            if routed.get("raw_dir"):
-                                rerouted["raw_dir"] = routed["raw_dir"]
-                            if routed.get("form"):
-                                rerouted["form"] = routed["form"]
-                            routed = rerouted
-                        except Exception as re_err:
-                            log.warning("reroute after ASR failed: %s", re_err)
-                        # Summarize ASR for readable note section
-                        try:
-                            asr_system = load_prompt(cfg.agent_config_path, "asr_summary")
-                            asr_user = {"asr_text": derived.asr_text, "type": routed.get("type")}
-                            asr_resp = llm.chat_json(asr_system, json.dumps(asr_user, ensure_ascii=False)).content or {}
-                            if isinstance(asr_resp, dict) and isinstance(asr_resp.get("asr_summary"), str):
-                                routed["asr_summary"] = asr_resp["asr_summary"].strip()
-                        except Exception as sum_err:
-                            log.warning("ASR summarize failed: %s", sum_err)
-                        # Also include raw transcript in payload for render
-                        routed["asr_text"] = derived.asr_text
-                    else:
-                        log.info("ASR returned empty text")
-                except Exception as ee:
-                    log.warning("asr extract failed: %s", ee)
-    except Exception as e:
-        log.warning("failed to download/save video: %s", e)
-    # Naming: use summary context for robust 2–3 word title
-    try:
-        naming_system = load_prompt(cfg.agent_config_path, "naming")
-        naming_input = json.dumps({
-            "type": routed.get("type"),
-            "summary": summary_obj,
-            "filenames": routed.get("filenames", []),
-            "hint_title": routed.get("title")
-        }, ensure_ascii=False)
-        named = llm.chat_json(naming_system, naming_input).content or {}
-        if isinstance(named.get("title"), str) and named["title"].strip():
-            routed["title"] = named["title"].strip()
-    except Exception:
-        pass
+    asr_text = summary_obj["derived"].get("asr_text")
+    if asr_text:
+        log.info("ASR captured len=%d", len(asr_text))
+        log.info("ASR text: %s", asr_text.strip()[:500])
+        # Summarize ASR first: the short summary also drives the type re-check
+        try:
+            asr_system = load_prompt(cfg.agent_config_path, "asr_summary")
+            asr_user = {"asr_text": asr_text, "type": routed.get("type")}
+            asr_resp = await _llm_json(llm, asr_system, jsonio.dumps(asr_user)) or {}
+            if isinstance(asr_resp, dict) and isinstance(asr_resp.get("asr_summary"), str):
+                routed["asr_summary"] = asr_resp["asr_summary"].strip()
+        except Exception as sum_err:
+            log.warning("ASR summarize failed: %s", sum_err)
+        # Content-driven re-check: only type/title may change, attachments stay as ingested
+        try:
+            override = await asyncio.to_thread(
+                reclassify_with_asr, llm, routed, routed.get("asr_summary") or asr_text[:_ASR_RECLASSIFY_CHARS]
+            )
+            if override:
+                log.info("ASR reclassify: %s", override)
+                routed.update(override)
+        except Exception as re_err:
+            log.warning("reroute after ASR failed: %s", re_err)
+        # Also include raw transcript in payload for render
+        routed["asr_text"] = asr_text
     routed.setdefault("title", "Без названия")
     routed.setdefault("created", date.today().isoformat())
     # keep original raw text for insertion to note body
     routed.setdefault("raw_text", bundle.raw_text)
     # merge extracted URLs into attachments.links and capture Telegram entities with anchors
     try:
-        import re
-        def _normalize_url(u: str) -> str:
-            return u.strip().strip(".,);]\'")
-
         links = set()
         anchors: dict[str, str] = {}
         # from routed (if any)
         for u in (routed.get("attachments", {}).get("links", []) or []):
             if isinstance(u, str) and u.startswith(("http://", "https://")):
                 links.add(_normalize_url(u))
-        # regex over raw text
-        for m in re.finditer(r"https?://[^\s)]+", bundle.raw_text or ""):
-            links.add(_normalize_url(m.group(0)))
+        # regex over raw text (matches never start with whitespace or trim chars)
+        links.update(u.rstrip(_URL_TRIM) for u in _URL_RE.findall(bundle.raw_text or ""))
         # telegram entities (text or caption)
         ents = message.entities if message.text is not None else message.caption_entities
         txt = message.text if message.text is not None else (message.caption or "")
@@ -265,128 +476,13 @@ async def handle_message(message: Message) -> None:
             routed["links_anchors"] = [{"url": u, "text": anchors[u]} for u in sorted(anchors.keys())]
     except Exception:
         pass
-    # Field fill: restrict to template fields
-    try:
-        enums_cfg = load_enums_config(cfg.agent_config_path)
-        allowed_fields = allowed_fields_for_type(routed["type"]) or []
-        field_system = load_prompt(cfg.agent_config_path, "field_fill")
-        user = {
-            "type": routed["type"],
-            "allowed_fields": allowed_fields,
-            "summary": summary_obj,
-            "filenames": routed.get("filenames", []),
-            "enums": {
-                "namespaces_controlled": enums_cfg.namespaces_controlled,
-                "common": enums_cfg.common,
-                "per_type": enums_cfg.per_type,
-            }
-        }
-        filled = llm.chat_json(field_system, json.dumps(user, ensure_ascii=False)).content or {}
-        for k in allowed_fields:
-            if k in filled:
-                routed[k] = filled[k]
-    except Exception as e:
-        log.warning("field_fill failed: %s", e)
-
-    # Tags step: generate from type, summary, attachments, enums, and filled fields
-    try:
-        enums_cfg = load_enums_config(cfg.agent_config_path)
-        tags_system = load_prompt(cfg.agent_config_path, "tags")
-        # Collect fields that were filled and may impact tags
-        fields_for_tags = {}
-        for k, v in routed.items():
-            if k not in {"type", "title", "created", "tags", "attachments", "source", "form", "raw_text", "raw_dir"}:
-                fields_for_tags[k] = v
-        tags_user = {
-            "type": routed.get("type"),
-            "summary": summary_obj,
-            "attachments": {"links": routed.get("attachments", {}).get("links", [])},
-            "enums": {
-                "namespaces_controlled": enums_cfg.namespaces_controlled,
-                "common": enums_cfg.common,
-                "per_type": enums_cfg.per_type,
-            },
-            "synonyms": enums_cfg.synonyms,
-            "filenames": routed.get("filenames", []),
-            "fields": fields_for_tags,
-        }
-        tag_resp = llm.chat_json(tags_system, json.dumps(tags_user, ensure_ascii=False)).content or []
-        # Normalize to list of strings
-        if isinstance(tag_resp, dict) and "tags" in tag_resp:
-            tag_candidates = tag_resp.get("tags") or []
-        else:
-            tag_candidates = tag_resp if isinstance(tag_resp, list) else []
-        # Normalize tags to all-English ASCII slugs (free namespaces), lower-case namespaces
-        def _translit_ru(s: str) -> str:
-            table = str.maketrans({
-                "а":"a","б":"b","в":"v","г":"g","д":"d","е":"e","ё":"e","ж":"zh","з":"z","и":"i","й":"i",
-                "к":"k","л":"l","м":"m","н":"n","о":"o","п":"p","р":"r","с":"s","т":"t","у":"u","ф":"f",
-                "х":"h","ц":"c","ч":"ch","ш":"sh","щ":"shch","ы":"y","э":"e","ю":"yu","я":"ya",
-                "А":"a","Б":"b","В":"v","Г":"g","Д":"d","Е":"e","Ё":"e","Ж":"zh","З":"z","И":"i","Й":"i",
-                "К":"k","Л":"l","М":"m","Н":"n","О":"o","П":"p","Р":"r","С":"s","Т":"t","У":"u","Ф":"f",
-                "Х":"h","Ц":"c","Ч":"ch","Ш":"sh","Щ":"shch","Ы":"y","Э":"e","Ю":"yu","Я":"ya",
-            })
-            return s.translate(table)
-
-        def _slug_ascii(s: str) -> str:
-            import re
-            s = _translit_ru(s)
-            s = s.lower()
-            s = s.replace(" ", "-").replace("_", "-")
-            s = re.sub(r"[^a-z0-9\-/]", "", s)
-            s = re.sub(r"-+", "-", s).strip("-")
-            return s
-
-        tag_values = []
-        for tag in tag_candidates:
-            if isinstance(tag, str) and "/" in tag:
-                ns, _, val = tag.strip().partition("/")
-                ns = (ns or "").strip().lower()
-                raw_val = (val or "").strip()
-                # apply synonyms if provided for namespace (exact match, case-insensitive)
-                syn_map = getattr(enums_cfg, "synonyms", {}).get(ns, {}) if 'enums_cfg' in locals() else {}
-                mapped = syn_map.get(raw_val.lower())
-                if mapped:
-                    raw_val = mapped
-                # candidate ascii slug
-                cand_slug = _slug_ascii(raw_val)
-                # if namespace is controlled (per config), try to map to allowed canonical values
-                per_type_enums = enums_cfg.per_type.get(routed.get("type", ""), {})
-                allowed_list = (enums_cfg.common.get(ns) or per_type_enums.get(ns)) or []
-                is_controlled = ns in enums_cfg.namespaces_controlled
-                if is_controlled and allowed_list:
-                    # pick allowed value whose slug matches candidate
-                    chosen = None
-                    for allowed_val in allowed_list:
-                        if _slug_ascii(str(allowed_val)) == cand_slug:
-                            chosen = allowed_val
-                            break
-                    if chosen:
-                        tag_values.append(f"{ns}/{chosen}")
-                    else:
-                        # no good match -> skip to avoid non-canonical values
-                        continue
-                else:
-                    # free namespace
-                    if ns and cand_slug:
-                        tag_values.append(f"{ns}/{cand_slug}")
-        # Filter controlled namespaces against enums
-        filtered = []
-        per_type_enums = enums_cfg.per_type.get(routed.get("type", ""), {})
-        for tag in tag_values:
-            ns, _, value = tag.partition("/")
-            if ns in enums_cfg.namespaces_controlled:
-                allowed = enums_cfg.common.get(ns) or per_type_enums.get(ns)
-                if allowed and value in allowed:
-                    filtered.append(tag)
-            else:
-                filtered.append(tag)
-        routed["tags"] = sorted(dict.fromkeys(filtered))
-    except Exception as e:
-        logging.getLogger("kb.bot").warning("tags generation failed: %s", e)
+    if bundle.raw_text.strip() or any(summary_obj["derived"].values()) or routed.get("filenames"):
+        await _complete_payload(llm, cfg, enums_cfg, routed, summary_obj)
+    else:
+        # Media without text, transcript or file name: keep the routed defaults
         routed.setdefault("tags", [])
 
-    rendered = render_note(cfg.templates_path, routed)
+    rendered = await asyncio.to_thread(render_note, cfg.templates_path, routed)
     _PENDING[message.from_user.id] = {"payload": routed, "rendered": rendered, "summary": summary_obj}
     folder_hint = Path(cfg.vault_path / "700_База_Данных")
     await message.answer(
@@ -402,17 +498,19 @@ async def main() -> None:
     cfg = load_config()
     if not cfg.telegram_bot_token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
-    bot = Bot(cfg.telegram_bot_token)
+    session = None
+    if cfg.telegram_api_base and cfg.telegram_api_base != "https://api.telegram.org":
+        session = AiohttpSession(api=TelegramAPIServer.from_base(cfg.telegram_api_base))
+    bot = Bot(cfg.telegram_bot_token, session=session)
+    global _EXTRACT_POOL
+    _EXTRACT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="kb-extract")
     dp = Dispatcher()
-    dp.message.register(handle_message, F.text)
-    dp.message.register(handle_message, F.caption)
-    # Also handle media-only updates
-    dp.message.register(handle_message, F.document)
-    dp.message.register(handle_message, F.photo)
-    dp.message.register(handle_message, F.video)
-    dp.message.register(handle_message, F.video_note)
-    dp.message.register(handle_message, F.audio)
-    dp.message.register(handle_message, F.voice)
+    dp.message.outer_middleware(_access_middleware)
+    # Text, captions and media-only updates
+    dp.message.register(
+        handle_message,
+        F.text | F.caption | F.document | F.photo | F.video | F.video_note | F.audio | F.voice,
+    )
 
     async def on_cancel(cb: CallbackQuery):
         _PENDING.pop(cb.from_user.id, None)
@@ -427,7 +525,7 @@ async def main() -> None:
             return
         payload = st["payload"]
         rendered = st["rendered"]
-        note_path = write_note(cfg_l.vault_path, payload["type"], payload["title"], rendered)
+        note_path = await asyncio.to_thread(write_note, cfg_l.vault_path, payload["type"], payload["title"], rendered)
         logging.getLogger("kb.bot").info("Written note: %s", note_path)
         await cb.message.edit_text(f"✅ Создано: {note_path.relative_to(cfg_l.vault_path)}\nТип: {payload['type']}")
         await cb.answer()
@@ -463,111 +561,13 @@ async def main() -> None:
         new_type = cb.data.split(":", 1)[1]
         st["payload"]["type"] = new_type
         cfg_l = load_config()
-        llm_l = LLMClient(cfg_l.deepseek_api_key, cfg_l.deepseek_base_url)
+        llm_l = get_llm()
         summary_l = st.get("summary")
-        # Re-run naming for the new type
-        try:
-            naming_system = load_prompt(cfg_l.agent_config_path, "naming")
-            naming_input = json.dumps({
-                "type": new_type,
-                "summary": summary_l,
-                "filenames": st["payload"].get("filenames", []),
-                "hint_title": st["payload"].get("title")
-            }, ensure_ascii=False)
-            named = llm_l.chat_json(naming_system, naming_input).content or {}
-            if isinstance(named.get("title"), str) and named["title"].strip():
-                st["payload"]["title"] = named["title"].strip()
-        except Exception:
-            pass
-        # Re-run field_fill with restricted fields
-        try:
-            enums_cfg = load_enums_config(cfg_l.agent_config_path)
-            allowed_fields = allowed_fields_for_type(new_type) or []
-            field_system = load_prompt(cfg_l.agent_config_path, "field_fill")
-            user = {
-                "type": new_type,
-                "allowed_fields": allowed_fields,
-                "summary": summary_l,
-                "filenames": st["payload"].get("filenames", []),
-                "enums": {
-                    "namespaces_controlled": enums_cfg.namespaces_controlled,
-                    "common": enums_cfg.common,
-                    "per_type": enums_cfg.per_type,
-                }
-            }
-            filled = llm_l.chat_json(field_system, json.dumps(user, ensure_ascii=False)).content or {}
-            for k in allowed_fields:
-                if k in filled:
-                    st["payload"][k] = filled[k]
-        except Exception:
-            pass
-        # Re-run tags
-        try:
-            enums_cfg = load_enums_config(cfg_l.agent_config_path)
-            tags_system = load_prompt(cfg_l.agent_config_path, "tags")
-            fields_for_tags = {}
-            for k, v in st["payload"].items():
-                if k not in {"type", "title", "created", "tags", "attachments", "source", "form", "raw_text", "raw_dir"}:
-                    fields_for_tags[k] = v
-            tags_user = {
-                "type": new_type,
-                "summary": summary_l,
-                "attachments": {"links": st["payload"].get("attachments", {}).get("links", [])},
-                "enums": {
-                    "namespaces_controlled": enums_cfg.namespaces_controlled,
-                    "common": enums_cfg.common,
-                    "per_type": enums_cfg.per_type,
-                },
-                "synonyms": enums_cfg.synonyms,
-                "filenames": st["payload"].get("filenames", []),
-                "fields": fields_for_tags,
-            }
-            tag_resp = llm_l.chat_json(tags_system, json.dumps(tags_user, ensure_ascii=False)).content or []
-            tag_candidates = tag_resp.get("tags") if isinstance(tag_resp, dict) else (tag_resp if isinstance(tag_resp, list) else [])
-            # Normalize as in main flow
-            def _translit_ru(s: str) -> str:
-                table = str.maketrans({
-                    "а":"a","б":"b","в":"v","г":"g","д":"d","е":"e","ё":"e","ж":"zh","з":"z","и":"i","й":"i",
-                    "к":"k","л":"l","м":"m","н":"n","о":"o","п":"p","р":"r","с":"s","т":"t","у":"u","ф":"f",
-                    "х":"h","ц":"c","ч":"ch","ш":"sh","щ":"shch","ы":"y","э":"e","ю":"yu","я":"ya",
-                    "А":"a","Б":"b","В":"v","Г":"g","Д":"d","Е":"e","Ё":"e","Ж":"zh","З":"z","И":"i","Й":"i",
-                    "К":"k","Л":"l","М":"m","Н":"n","О":"o","П":"p","Р":"r","С":"s","Т":"t","У":"u","Ф":"f",
-                    "Х":"h","Ц":"c","Ч":"ch","Ш":"sh","Щ":"shch","Ы":"y","Э":"e","Ю":"yu","Я":"ya",
-                })
-                return s.translate(table)
-            def _slug_ascii(s: str) -> str:
-                import re
-                s = _translit_ru(s).lower().replace(" ", "-").replace("_", "-")
-                s = re.sub(r"[^a-z0-9\-/]", "", s)
-                s = re.sub(r"-+", "-", s).strip("-")
-                return s
-            tag_values = []
-            for tag in (tag_candidates or []):
-                if isinstance(tag, str) and "/" in tag:
-                    ns, _, val = tag.strip().partition("/")
-                    ns = (ns or "").strip().lower()
-                    raw_val = (val or "").strip()
-                    syn_map = getattr(enums_cfg, "synonyms", {}).get(ns, {})
-                    mapped = syn_map.get(raw_val.lower())
-                    if mapped:
-                        raw_val = mapped
-                    val = _slug_ascii(raw_val)
-                    if ns and val:
-                        tag_values.append(f"{ns}/{val}")
-            filtered = []
-            per_type_enums = enums_cfg.per_type.get(new_type, {})
-            for tag in tag_values:
-                ns, _, value = tag.partition("/")
-                if ns in enums_cfg.namespaces_controlled:
-                    allowed = enums_cfg.common.get(ns) or per_type_enums.get(ns)
-                    if allowed and value in allowed:
-                        filtered.append(tag)
-                else:
-                    filtered.append(tag)
-            st["payload"]["tags"] = sorted(dict.fromkeys(filtered))
-        except Exception:
-            pass
-        st["rendered"] = render_note(cfg_l.templates_path, st["payload"])
+        # Re-run naming, field fill (restricted fields) and tags for the new type
+        await _complete_payload(
+            llm_l, cfg_l, load_enums_config(cfg_l.agent_config_path), st["payload"], summary_l
+        )
+        st["rendered"] = await asyncio.to_thread(render_note, cfg_l.templates_path, st["payload"])
         await cb.message.edit_text(
             f"Готово к сохранению — тип: {new_type}\nНазвание: {st['payload']['title']}",
             reply_markup=_preview_keyboard().as_markup(),
@@ -617,7 +617,10 @@ async def main() -> None:
     dp.callback_query.register(on_set_type, F.data.startswith("set_type:"))
     dp.callback_query.register(on_types_page, F.data.startswith("types:"))
     dp.callback_query.register(on_back, F.data == "back")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        _EXTRACT_POOL.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
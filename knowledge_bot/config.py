@@ -1,5 +1,6 @@
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
@@ -11,14 +12,18 @@ class AppConfig:
     agent_config_path: Path
     export_root: Path
     attachments_root: Path
+    cache_dir: Path
     telegram_bot_token: Optional[str]
     telegram_user_id: Optional[int]
     telegram_api_base: Optional[str]
     asr_model: Optional[str]
     deepseek_api_key: Optional[str]
     deepseek_base_url: Optional[str]
+    batch_concurrency: Optional[int]
+    batch_fetch_concurrency: Optional[int]
 
 
+@lru_cache(maxsize=1)
 def load_config() -> AppConfig:
     vault_path = Path(os.environ.get("VAULT_PATH", "/Users/aeshef/Documents/Obsidian Vault")).resolve()
     templates_path_env = os.environ.get("TEMPLATES_PATH")
@@ -27,6 +32,8 @@ def load_config() -> AppConfig:
     agent_config_path = Path(agent_config_path_env).resolve() if agent_config_path_env else (vault_path / "800_Автоматизация" / "Agent" / "config")
     export_root = vault_path / "700_База_Данных" / "Export"
     attachments_root = vault_path / "700_База_Данных" / "_Вложения"
+    cache_dir_env = os.environ.get("CACHE_DIR")
+    cache_dir = Path(cache_dir_env).resolve() if cache_dir_env else (agent_config_path / ".cache")
     telegram_bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
     telegram_user_id_raw = os.environ.get("TELEGRAM_USER_ID")
     telegram_user_id = int(telegram_user_id_raw) if telegram_user_id_raw and telegram_user_id_raw.isdigit() else None
@@ -34,6 +41,10 @@ def load_config() -> AppConfig:
     asr_model = os.environ.get("ASR_MODEL")
     deepseek_api_key = os.environ.get("DEEPSEEK_API_KEY")
     deepseek_base_url = os.environ.get("DEEPSEEK_BASE_URL")
+    batch_concurrency_raw = os.environ.get("BATCH_CONCURRENCY")
+    batch_concurrency = int(batch_concurrency_raw) if batch_concurrency_raw and batch_concurrency_raw.isdigit() else None
+    batch_fetch_concurrency_raw = os.environ.get("BATCH_FETCH_CONCURRENCY")
+    batch_fetch_concurrency = int(batch_fetch_concurrency_raw) if batch_fetch_concurrency_raw and batch_fetch_concurrency_raw.isdigit() else None
 
     return AppConfig(
         vault_path=vault_path,
@@ -41,12 +52,15 @@ def load_config() -> AppConfig:
         agent_config_path=agent_config_path,
         export_root=export_root,
         attachments_root=attachments_root,
+        cache_dir=cache_dir,
         telegram_bot_token=telegram_bot_token,
         telegram_user_id=telegram_user_id,
         telegram_api_base=telegram_api_base,
         asr_model=asr_model,
         deepseek_api_key=deepseek_api_key,
         deepseek_base_url=deepseek_base_url,
+        batch_concurrency=batch_concurrency,
+        batch_fetch_concurrency=batch_fetch_concurrency,
     )
 
 
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import ast
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple
 
 import yaml
 
 from .config import load_config
+from .settings import load_yaml_cached
 
 
 SUGGESTER_RE = re.compile(
@@ -14,23 +17,29 @@ SUGGESTER_RE = re.compile(
     re.DOTALL,
 )
 
+_PARALLEL_MIN_FILES = 16
+
+_STR_LIT_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'')
+
 # Match type: "идея" (quote optional)
 TYPE_LITERAL_RE = re.compile(r'type:\s*"?([^"\n]+)"?')
 
 
 def parse_array(src: str) -> List[str]:
-    # Try robust parsing using ast; fallback to quoted string regex
-    import ast
-    try:
-        val = ast.literal_eval(f'[{src}]')
-        return [str(x).strip() for x in val if isinstance(x, str) and x.strip()]
-    except Exception:
-        items: List[str] = []
-        for m in re.finditer(r'"(.*?)"|\'(.*?)\'', src):
-            s = (m.group(1) or m.group(2) or '').strip()
-            if s:
-                items.append(s)
-        return items
+    # Suggester arrays hold quoted string literals only; plain ones need no AST
+    items: List[str] = []
+    for m in _STR_LIT_RE.finditer(src):
+        s = m.group(1) if m.group(1) is not None else m.group(2)
+        if "\\" in s:
+            # Escapes (\t, \n, \uXXXX, ...): let Python decode just this literal
+            try:
+                s = ast.literal_eval(m.group(0))
+            except (ValueError, SyntaxError):
+                continue
+        s = s.strip()
+        if s:
+            items.append(s)
+    return items
 
 
 def extract_type_name(file_text: str) -> str | None:
@@ -38,31 +47,43 @@ def extract_type_name(file_text: str) -> str | None:
     return m.group(1) if m else None
 
 
+def _parse_one(path: Path) -> Tuple[str, Dict[str, List[str]], Set[str]]:
+    text = path.read_text(encoding="utf-8", errors="ignore")
+    type_name = extract_type_name(text) or ""
+    local_fields: Dict[str, List[str]] = {}
+    for m in SUGGESTER_RE.finditer(text):
+        field = m.group(1)
+        # ui choices (group 1) ignored; values (group 3) used
+        values = parse_array(m.group(3))
+        if values:
+            local_fields[field] = values
+    return type_name, local_fields, set(local_fields)
+
+
 def main() -> None:
     cfg = load_config()
     templates_dir = cfg.vault_path / "800_Автоматизация" / "Templates" / "Сущности"
-    files = list(templates_dir.glob("*.md"))
+    files = sorted(templates_dir.glob("*.md"))
     per_type: Dict[str, Dict[str, List[str]]] = {}
     namespaces_controlled: set[str] = set()
 
-    for path in files:
-        text = path.read_text(encoding="utf-8", errors="ignore")
-        type_name = extract_type_name(text) or ""
-        local_fields: Dict[str, List[str]] = {}
-        for m in SUGGESTER_RE.finditer(text):
-            field = m.group(1)
-            # ui choices (group 1) ignored; values (group 3) used
-            values = parse_array(m.group(3))
-            if values:
-                local_fields[field] = values
-                namespaces_controlled.add(field)
+    # Worker start-up outweighs the parse for a handful of templates
+    if len(files) >= _PARALLEL_MIN_FILES:
+        with ProcessPoolExecutor() as ex:
+            parsed = list(ex.map(_parse_one, files, chunksize=4))
+    else:
+        parsed = [_parse_one(path) for path in files]
+
+    # Merge in file order so results match the sequential scan
+    for type_name, local_fields, fields_seen in parsed:
+        namespaces_controlled.update(fields_seen)
         if local_fields and type_name:
             per_type.setdefault(type_name, {}).update(local_fields)
 
     enums_path = cfg.agent_config_path / "enums.yaml"
     existing = {}
     if enums_path.exists():
-        existing = yaml.safe_load(enums_path.read_text(encoding="utf-8")) or {}
+        existing = load_yaml_cached(enums_path) or {}
 
     # Merge with existing
     existing_namespaces = set((existing.get("namespaces", {}) or {}).get("controlled", []))
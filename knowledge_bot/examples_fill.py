@@ -1,17 +1,20 @@
 from __future__ import annotations
 
 import argparse
-import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
 import pandas as pd
+from openpyxl import Workbook
 
+from . import jsonio
 from .config import load_config
 from .llm import LLMClient
-from .settings import load_prompt, load_types_config, load_enums_config
+from .settings import EnumsConfig, TypesConfig, load_prompt, load_types_config, load_enums_config
 from .extract import simple_from_text, extract_from_url, extract_from_path
-from .routing import route_and_fill
+from .routing import normalize_route, route_and_fill
 
 
 COLUMNS = [
@@ -25,6 +28,8 @@ COLUMNS = [
     "notes",
 ]
 
+OUTPUT_COLUMNS = ["expected_type", "expected_title", "expected_tags", "expected_fields_json", "notes"]
+
 
 def detect_bundle(s: str):
     p = Path(s)
@@ -35,43 +40,107 @@ def detect_bundle(s: str):
     return simple_from_text(s)
 
 
-def fill_row(llm: LLMClient, text: str) -> dict[str, Any]:
+@dataclass(frozen=True)
+class FillContext:
+    # Per-run constants, resolved once instead of per spreadsheet row
+    naming_system: str
+    field_system: str
+    batch_system: str
+    types_cfg: TypesConfig
+    enums_cfg: EnumsConfig
+
+
+def _system_with_context(prompt: str, context: dict[str, Any]) -> str:
+    # Static inputs ride in the system prompt, so every row shares a byte-identical cached prefix
+    return prompt.rstrip() + "\n\nСТАТИЧЕСКИЙ ВХОД (JSON):\n" + jsonio.dumps(context)
+
+
+def load_fill_context() -> FillContext:
     cfg = load_config()
+    types_cfg = load_types_config(cfg.agent_config_path)
+    enums_cfg = load_enums_config(cfg.agent_config_path)
+    enums = enums_cfg.prompt_payload()
+    return FillContext(
+        naming_system=load_prompt(cfg.agent_config_path, "naming"),
+        field_system=_system_with_context(load_prompt(cfg.agent_config_path, "field_fill"), {"enums": enums}),
+        batch_system=_system_with_context(
+            load_prompt(cfg.agent_config_path, "examples_batch"),
+            {"allowed_types": types_cfg.type_names, "enums": enums},
+        ),
+        types_cfg=types_cfg,
+        enums_cfg=enums_cfg,
+    )
+
+
+def _result_row(routed: dict[str, Any], filled: dict[str, Any]) -> dict[str, Any]:
+    tags = routed.get("tags") or []
+    return {
+        "expected_type": routed.get("type"),
+        "expected_title": routed.get("title"),
+        "expected_tags": ",".join(tags) if tags else "",
+        "expected_fields_json": jsonio.dumps(filled) if filled else "",
+    }
+
+
+def fill_row(llm: LLMClient, text: str, ctx: FillContext | None = None) -> dict[str, Any]:
+    ctx = ctx or load_fill_context()
     bundle = detect_bundle(text)
-    routed = route_and_fill(llm, bundle.to_summary(), source_hint="examples")
+    summary = bundle.to_summary()
+    routed = route_and_fill(llm, summary, source_hint="examples")
     # naming
     try:
-        naming_system = load_prompt(cfg.agent_config_path, "naming")
-        named = llm.chat_json(naming_system, json.dumps({"type": routed.get("type"), "title": routed.get("title")}, ensure_ascii=False)).content or {}
+        named = llm.chat_json(ctx.naming_system, jsonio.dumps({"type": routed.get("type"), "title": routed.get("title")})).content or {}
         if isinstance(named.get("title"), str) and named["title"].strip():
             routed["title"] = named["title"].strip()
     except Exception:
         pass
     # field fill
-    enums_cfg = load_enums_config(cfg.agent_config_path)
-    types_cfg = load_types_config(cfg.agent_config_path)
-    template_name = types_cfg.template_for(routed["type"])  # not used directly, but asserts type exists
-    field_system = load_prompt(cfg.agent_config_path, "field_fill")
+    template_name = ctx.types_cfg.template_for(routed["type"])  # not used directly, but asserts type exists
     user = {
         "type": routed["type"],
         "allowed_fields": [],  # для примеров не ограничиваем, LLM вернёт минимум
-        "summary": bundle.to_summary(),
-        "enums": {
-            "namespaces_controlled": enums_cfg.namespaces_controlled,
-            "common": enums_cfg.common,
-            "per_type": enums_cfg.per_type,
-        }
-    }
-    filled = llm.chat_json(field_system, json.dumps(user, ensure_ascii=False)).content or {}
-    # collect tags
-    tags = routed.get("tags") or []
-    result = {
-        "expected_type": routed.get("type"),
-        "expected_title": routed.get("title"),
-        "expected_tags": ",".join(tags) if tags else "",
-        "expected_fields_json": json.dumps(filled, ensure_ascii=False) if filled else "",
+        "summary": summary,
     }
-    return result
+    filled = llm.chat_json(ctx.field_system, jsonio.dumps(user)).content or {}
+    return _result_row(routed, filled)
+
+
+def fill_rows_batch(llm: LLMClient, texts: list[str], ctx: FillContext | None = None) -> list[dict[str, Any] | None]:
+    """Route, name and fill several rows with one request.
+
+    Results follow ``texts``; rows missing from the reply are None so the caller can retry them with fill_row.
+    """
+    ctx = ctx or load_fill_context()
+    user = jsonio.dumps({
+        "items": [{"i": i, "summary": detect_bundle(text).to_summary()} for i, text in enumerate(texts)],
+    })
+    resp = llm.chat_json(ctx.batch_system, user).content
+    replies = resp.get("results") if isinstance(resp, dict) else None
+    by_index: dict[int, dict[str, Any]] = {}
+    for item in replies if isinstance(replies, list) else []:
+        if isinstance(item, dict) and isinstance(item.get("i"), int) and 0 <= item["i"] < len(texts):
+            by_index.setdefault(item["i"], item)
+    results: list[dict[str, Any] | None] = []
+    for i in range(len(texts)):
+        item = by_index.get(i)
+        if item is None:
+            results.append(None)
+            continue
+        filled = item.pop("fields", None)
+        item.pop("i", None)
+        routed = normalize_route(item, "examples", ctx.types_cfg, ctx.enums_cfg)
+        results.append(_result_row(routed, filled if isinstance(filled, dict) else {}))
+    return results
+
+
+def write_xlsx_streaming(df: pd.DataFrame, out_path: Path) -> None:
+    # write_only workbook flushes rows as they are appended instead of holding a cell tree
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append([str(c) for c in df.columns])
+    for row in df.itertuples(index=False, name=None):
+        ws.append([None if pd.isna(v) else v for v in row])
+    wb.save(out_path)
 
 
 def main() -> None:
@@ -80,17 +149,20 @@ def main() -> None:
     parser.add_argument("--output", type=Path, default=None, help="Output path (.xlsx). Defaults to *_filled.xlsx next to input")
     parser.add_argument("--sheet", type=str, default=None, help="Excel sheet name (if not first)")
     parser.add_argument("--force", action="store_true", help="Fill even if expected_type already present")
+    parser.add_argument("--batch-size", type=int, default=8, help="Rows per LLM request (1 = one row at a time)")
     args = parser.parse_args()
 
     cfg = load_config()
     llm = LLMClient(cfg.deepseek_api_key, cfg.deepseek_base_url)
+    ctx = load_fill_context()
 
     in_path = args.input_path or (cfg.agent_config_path / "examples_template.xlsx")
     if not in_path.exists():
         raise FileNotFoundError(f"Input not found: {in_path}")
 
     if in_path.suffix.lower() == ".csv":
-        df = pd.read_csv(in_path)
+        # Everything is text here; skip per-column type inference
+        df = pd.read_csv(in_path, dtype=str)
     else:
         # If sheet not specified, read first sheet explicitly (sheet_name=0)
         if args.sheet is None:
@@ -105,24 +177,50 @@ def main() -> None:
         if col not in df.columns:
             df[col] = ""
 
-    processed = 0
-    for idx, row in df.iterrows():
-        text = str(row.get("input") or "").strip()
-        if not text:
-            continue
+    # Whole-column reads instead of per-row Series boxing; positions index the lists below
+    inputs = df["input"].fillna("").astype(str).str.strip()
+    todo = inputs.ne("")
+    if not args.force:
         # only fill missing outputs unless forced
-        if not args.force and str(row.get("expected_type") or "").strip():
-            continue
-        try:
-            out = fill_row(llm, text)
-            for k, v in out.items():
-                df.at[idx, k] = v
-            processed += 1
-        except Exception as e:
-            df.at[idx, "notes"] = f"error: {e}"
+        todo &= df["expected_type"].fillna("").astype(str).str.strip().eq("")
+    texts = inputs.tolist()
+    pending: list[tuple[int, str]] = [(pos, texts[pos]) for pos in todo.to_numpy().nonzero()[0].tolist()]
+
+    def fill_chunk(chunk: list[tuple[int, str]]) -> list[dict[str, Any] | Exception]:
+        outs: list[dict[str, Any] | None] = [None] * len(chunk)
+        if batch_size > 1:
+            try:
+                outs = fill_rows_batch(llm, [text for _, text in chunk], ctx)
+            except Exception:
+                pass  # rows fall back to fill_row below
+        results: list[dict[str, Any] | Exception] = []
+        for (_, text), out in zip(chunk, outs):
+            try:
+                results.append(out or fill_row(llm, text, ctx))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    # Chunks are independent network-bound work; df is only touched on this thread
+    batch_size = max(1, args.batch_size)
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    processed = 0
+    outputs = {col: df[col].tolist() for col in OUTPUT_COLUMNS}
+    with ThreadPoolExecutor(max_workers=cfg.batch_concurrency or 8) as pool:
+        for chunk, results in zip(chunks, pool.map(fill_chunk, chunks)):
+            for (pos, _), out in zip(chunk, results):
+                if isinstance(out, Exception):
+                    outputs["notes"][pos] = f"error: {out}"
+                    continue
+                for k, v in out.items():
+                    outputs[k][pos] = v
+                processed += 1
+    # One assignment per column: no per-cell dtype coercion
+    for col, values in outputs.items():
+        df[col] = values
 
     out_path = args.output or (in_path.with_name(in_path.stem + "_filled.xlsx"))
-    df.to_excel(out_path, index=False)
+    write_xlsx_streaming(df, out_path)
     print(f"written: {out_path} | rows processed: {processed} / {len(df)}")
 
 
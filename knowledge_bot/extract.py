@@ -4,28 +4,55 @@ from dataclasses import dataclass
 import re
 from pathlib import Path
 from typing import Any, Optional
+import importlib
 import os
 import logging
+import threading
+from functools import lru_cache
+
+
+_URL_RE = re.compile(r"https?://[^\s)]+")
+_OG_TITLE_RE = re.compile(r'<meta[^>]+property=["\']og:title["\'][^>]+content=["\']([^"\']+)["\']', re.IGNORECASE)
+_TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+_WS_RE = re.compile(r"\s+")
+# Cap on extracted PDF text; downstream prompts only need the opening part of long documents
+_PDF_MAX_CHARS = 200_000
+# Serializes first-time ASR model loads between extraction threads
+_ASR_LOAD_LOCK = threading.Lock()
 
 
 def _safe_import(name: str):
     try:
-        return __import__(name)
+        return importlib.import_module(name)
     except Exception:
         return None
 
 
-trafilatura = _safe_import("trafilatura")
-pdfminer = _safe_import("pdfminer.high_level")
-PIL = _safe_import("PIL")
-pytesseract = _safe_import("pytesseract")
+@lru_cache(maxsize=None)
+def _optional(name: str):
+    # Heavy extras (torch via whisper, pdfminer, OCR) load on first use, not at bot start-up
+    return _safe_import(name)
+
+
 requests = _safe_import("requests")
-fwhisper = _safe_import("faster_whisper")
-owhisper = _safe_import("whisper")
 import tempfile
 import subprocess
 
 
+def _make_session():
+    if requests is None:
+        return None
+    # One keep-alive pool for all page fetches (same hosts repeat a lot in batches)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _make_session()
+
+
 @dataclass
 class ExtractedBundle:
     raw_text: str = ""
@@ -54,10 +81,10 @@ class ExtractedBundle:
 def simple_from_text(text: str) -> ExtractedBundle:
     log = logging.getLogger("kb.extract")
     urls: list[str] = []
-    for m in re.finditer(r"https?://[^\s)]+", text):
-        urls.append(m.group(0))
+    urls.extend(_URL_RE.findall(text))
     url_text = ""
     if urls:
+        trafilatura = _optional("trafilatura")
         if trafilatura is None:
             log.info("trafilatura not installed; skip URL extract (urls=%d)", len(urls))
         else:
@@ -68,28 +95,30 @@ def simple_from_text(text: str) -> ExtractedBundle:
             except Exception as e:
                 log.warning("trafilatura failed: %s", e)
         # Fallback: extract page title via requests if no body text
-        if not url_text and requests is not None:
+        if not url_text and _SESSION is not None:
             try:
-                resp = requests.get(urls[0], headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
+                resp = _SESSION.get(urls[0], headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
                 html = resp.text or ""
                 # Try og:title first
-                m = re.search(r'<meta[^>]+property=["\']og:title["\'][^>]+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+                m = _OG_TITLE_RE.search(html)
                 if m:
                     url_text = m.group(1).strip()
                 else:
                     # Then <title>
-                    m2 = re.search(r"<title[^>]*>(.*?)</title>", html, re.IGNORECASE | re.DOTALL)
+                    m2 = _TITLE_RE.search(html)
                     if m2:
-                        url_text = re.sub(r"\s+", " ", m2.group(1)).strip()
+                        url_text = _WS_RE.sub(" ", m2.group(1)).strip()
                 log.info("url_title fallback: %s (len=%d)", "yes" if url_text else "no", len(url_text or ""))
             except Exception as e:
                 log.warning("requests title fallback failed: %s", e)
     return ExtractedBundle(raw_text=text, urls=urls, meta={}, url_text=url_text)
 
 
-def extract_from_url(url: str) -> ExtractedBundle:
+def extract_from_url(url: str, session: Any = None) -> ExtractedBundle:
     log = logging.getLogger("kb.extract")
+    http = session or _SESSION
     txt = ""
+    trafilatura = _optional("trafilatura")
     if trafilatura is not None:
         try:
             fetched = trafilatura.fetch_url(url)
@@ -97,17 +126,17 @@ def extract_from_url(url: str) -> ExtractedBundle:
             log.info("extract_from_url: len=%d %s", len(txt or ""), url)
         except Exception as e:
             log.warning("extract_from_url failed: %s", e)
-    if not txt and requests is not None:
+    if not txt and http is not None:
         try:
-            resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
+            resp = http.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
             html = resp.text or ""
-            m = re.search(r'<meta[^>]+property=["\']og:title["\'][^>]+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+            m = _OG_TITLE_RE.search(html)
             if m:
                 txt = m.group(1).strip()
             else:
-                m2 = re.search(r"<title[^>]*>(.*?)</title>", html, re.IGNORECASE | re.DOTALL)
+                m2 = _TITLE_RE.search(html)
                 if m2:
-                    txt = re.sub(r"\s+", " ", m2.group(1)).strip()
+                    txt = _WS_RE.sub(" ", m2.group(1)).strip()
             log.info("extract_from_url title fallback: len=%d %s", len(txt or ""), url)
         except Exception as e:
             log.warning("requests title fallback failed: %s", e)
@@ -116,13 +145,29 @@ def extract_from_url(url: str) -> ExtractedBundle:
 
 def extract_from_pdf(path: Path) -> str:
     log = logging.getLogger("kb.extract")
-    if pdfminer is None:
+    pdf_high_level = _optional("pdfminer.high_level")
+    if pdf_high_level is None:
         log.info("pdfminer not installed; skip PDF extract: %s", path)
         return ""
+    max_pages_raw = os.environ.get("PDF_MAX_PAGES", "")
+    max_pages = int(max_pages_raw) if max_pages_raw.isdigit() else 20
     try:
-        # pdfminer.high_level.extract_text
-        txt = pdfminer.high_level.extract_text(str(path)) or ""
-        log.info("extract_from_pdf: len=%d %s", len(txt or ""), path)
+        from pdfminer.layout import LTTextContainer
+
+        # Page by page, stopping once enough text for summarization is collected
+        parts: list[str] = []
+        size = 0
+        for page in pdf_high_level.extract_pages(str(path), maxpages=max_pages):
+            for element in page:
+                if isinstance(element, LTTextContainer):
+                    chunk = element.get_text()
+                    parts.append(chunk)
+                    size += len(chunk)
+            parts.append("\f")
+            if size > _PDF_MAX_CHARS:
+                break
+        txt = "".join(parts)[:_PDF_MAX_CHARS]
+        log.info("extract_from_pdf: len=%d %s", len(txt), path)
         return txt
     except Exception as e:
         log.warning("extract_from_pdf failed: %s", e)
@@ -131,11 +176,13 @@ def extract_from_pdf(path: Path) -> str:
 
 def extract_from_image(path: Path) -> str:
     log = logging.getLogger("kb.extract")
-    if PIL is None or pytesseract is None:
+    pil_image = _optional("PIL.Image")
+    pytesseract = _optional("pytesseract")
+    if pil_image is None or pytesseract is None:
         log.info("Pillow/pytesseract not installed; skip OCR: %s", path)
         return ""
     try:
-        img = PIL.Image.open(str(path))
+        img = pil_image.open(str(path))
         txt = pytesseract.image_to_string(img) or ""
         log.info("extract_from_image: len=%d %s", len(txt or ""), path)
         return txt
@@ -160,6 +207,31 @@ def extract_from_path(path_str: str, note_text: Optional[str] = None) -> Extract
     return ExtractedBundle(raw_text=raw, urls=[], meta={"file": str(path)})
 
 
+def _decode_audio_np(src: Path):
+    """16 kHz mono float32 samples decoded with PyAV (no subprocess, no temp file), or None."""
+    av = _optional("av")
+    np = _optional("numpy")
+    if av is None or np is None:
+        return None
+    log = logging.getLogger("kb.extract")
+    try:
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+        chunks = []
+        with av.open(str(src)) as container:
+            stream = container.streams.audio[0]
+            for frame in container.decode(stream):
+                for out in resampler.resample(frame):
+                    chunks.append(out.to_ndarray().reshape(-1))
+            for out in resampler.resample(None):
+                chunks.append(out.to_ndarray().reshape(-1))
+        if not chunks:
+            return None
+        return np.concatenate(chunks).astype(np.float32) / 32768.0
+    except Exception as e:
+        log.warning("pyav decode failed: %s", e)
+        return None
+
+
 def _ffmpeg_extract_wav(src: Path) -> Optional[Path]:
     log = logging.getLogger("kb.extract")
     try:
@@ -173,6 +245,29 @@ def _ffmpeg_extract_wav(src: Path) -> Optional[Path]:
         return None
 
 
+@lru_cache(maxsize=1)
+def _asr_device() -> tuple[str, str]:
+    # (device, faster-whisper compute_type): int8 weights with fp16 compute on GPU, plain int8 on CPU
+    torch = _optional("torch")
+    try:
+        if torch is not None and torch.cuda.is_available():
+            return "cuda", "int8_float16"
+    except Exception:
+        pass
+    return "cpu", "int8"
+
+
+# Model loads dominate short clips: keep loaded models for the process lifetime
+@lru_cache(maxsize=4)
+def _whisper_model(model_name: str, device: str):
+    return _optional("whisper").load_model(model_name, device=device)
+
+
+@lru_cache(maxsize=4)
+def _faster_whisper_model(model_name: str, device: str, compute_type: str):
+    return _optional("faster_whisper").WhisperModel(model_name, device=device, compute_type=compute_type)
+
+
 def transcribe_av(path: Path, model_name: Optional[str] = None) -> str:
     log = logging.getLogger("kb.extract")
     model_name = model_name or os.environ.get("ASR_MODEL", "small")
@@ -192,7 +287,7 @@ def transcribe_av(path: Path, model_name: Optional[str] = None) -> str:
             api_key = os.environ.get("OLLAMA_API_KEY") or os.environ.get("OPENAI_API_KEY") or os.environ.get("ASR_API_KEY")
             endpoint_path = os.environ.get("ASR_ENDPOINT", "/v1/audio/transcriptions")
             is_ollama_base = bool(base_url) and ("11434" in base_url or "ollama" in base_url.lower())
-            if base_url and api_key and not is_ollama_base:
+            if base_url and api_key and not is_ollama_base and _SESSION is not None:
                 url = base_url.rstrip("/") + endpoint_path
                 headers = {"Authorization": f"Bearer {api_key}"}
                 files = {
@@ -204,7 +299,10 @@ def transcribe_av(path: Path, model_name: Optional[str] = None) -> str:
                 if first_lang:
                     data["language"] = first_lang
                 log.info("ASR http: url=%s model=%s", url, model_name)
-                resp = requests.post(url, headers=headers, data=data, files=files, timeout=600)
+                try:
+                    resp = _SESSION.post(url, headers=headers, data=data, files=files, timeout=600)
+                finally:
+                    files["file"][1].close()
                 if resp.status_code == 200:
                     j = resp.json()
                     text = (j.get("text") if isinstance(j, dict) else "") or ""
@@ -222,28 +320,36 @@ def transcribe_av(path: Path, model_name: Optional[str] = None) -> str:
         except Exception as e:
             log.warning("ASR http exception: %s", e)
     # Prefer OpenAI Whisper if installed (CPU ok, small model)
-    if owhisper is not None:
+    if _optional("whisper") is not None:
         try:
-            # convert to wav for stability
-            wav = _ffmpeg_extract_wav(path) or path
-            model = owhisper.load_model(model_name)
-            for lang in prefs:
-                lang_arg = None if lang == "auto" else lang
-                result = model.transcribe(str(wav), language=lang_arg, task="transcribe")
-                text = (result or {}).get("text", "")
-                log.info("ASR(whisper) try lang=%s → len=%d", lang, len(text or ""))
-                if text:
-                    try:
-                        log.info("ASR(whisper) text: %s", (text or "").strip()[:500])
-                    except Exception:
-                        pass
-                    return text
+            # decode in-process to 16 kHz mono; ffmpeg-to-wav only when PyAV/numpy are missing
+            audio = _decode_audio_np(path)
+            wav = _ffmpeg_extract_wav(path) if audio is None else None
+            source = audio if audio is not None else str(wav or path)
+            with _ASR_LOAD_LOCK:
+                model = _whisper_model(model_name, _asr_device()[0])
+            try:
+                for lang in prefs:
+                    lang_arg = None if lang == "auto" else lang
+                    result = model.transcribe(source, language=lang_arg, task="transcribe")
+                    text = (result or {}).get("text", "")
+                    log.info("ASR(whisper) try lang=%s → len=%d", lang, len(text or ""))
+                    if text:
+                        try:
+                            log.info("ASR(whisper) text: %s", (text or "").strip()[:500])
+                        except Exception:
+                            pass
+                        return text
+            finally:
+                if wav is not None:
+                    wav.unlink(missing_ok=True)
         except Exception as e:
             log.warning("whisper failed: %s", e)
     # Fallback to faster-whisper
-    if fwhisper is not None:
+    if _optional("faster_whisper") is not None:
         try:
-            model = fwhisper.WhisperModel(model_name, compute_type="int8")
+            with _ASR_LOAD_LOCK:
+                model = _faster_whisper_model(model_name, *_asr_device())
             for lang in prefs:
                 lang_arg = None if lang == "auto" else lang
                 for vad in (True, False):
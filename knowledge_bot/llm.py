@@ -1,17 +1,31 @@
 from __future__ import annotations
 
-import json
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any
 
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 import re
+import threading
 
+try:
+    import httpx
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+except ImportError:
+    httpx = None
+
+from . import jsonio
 from .config import load_config
+from .llm_cache import LLMCache, cache_key, shared_cache
 from .settings import load_types_config
 
+# Quotes excluded: the fallback scans JSON-encoded prompts
+_URL_RE = re.compile(r"https?://[^\s)\"']+")
+_WS_RE = re.compile(r"\s+")
+
 
 @dataclass
 class LLMResult:
@@ -19,15 +33,57 @@ class LLMResult:
 
 
 class LLMClient:
-    def __init__(self, api_key: str | None, base_url: str | None):
+    def __init__(
+        self,
+        api_key: str | None,
+        base_url: str | None,
+        max_concurrency: int | None = None,
+        cache: LLMCache | None = None,
+    ):
         self.api_key = api_key
         self.base_url = base_url or os.environ.get("DEEPSEEK_BASE_URL") or "https://api.deepseek.com/v1"
+        # Cap in-flight requests when the client is shared between worker threads
+        limit_raw = os.environ.get("LLM_MAX_CONCURRENCY", "")
+        limit = max_concurrency or (int(limit_raw) if limit_raw.isdigit() else 8)
+        self._slots = threading.BoundedSemaphore(max(1, limit))
+        self._cache = cache if cache is not None else shared_cache()
+        self._http2 = httpx is not None and os.environ.get("LLM_HTTP2", "1").strip().lower() not in ("0", "false", "no")
+        if self._http2:
+            # Concurrent calls multiplex as streams over one TLS connection
+            self._client = httpx.Client(
+                http2=True,
+                timeout=60,
+                limits=httpx.Limits(max_connections=max(1, limit), max_keepalive_connections=max(1, limit)),
+            )
+        else:
+            # Keep-alive pool sized to the concurrency cap: one TLS handshake per worker, not per call
+            self._client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, limit))
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+
+    def _post(self, url: str, headers: dict[str, str], body: str):
+        if self._http2:
+            return self._client.post(url, headers=headers, content=body.encode("utf-8"))
+        return self._client.post(url, headers=headers, data=body.encode("utf-8"), timeout=60)
 
-    def chat_json(self, system_prompt: str, user_prompt: str, model: str = "deepseek-chat") -> LLMResult:
+    def chat_json(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str = "deepseek-chat",
+        temperature: float = 0.1,
+        max_tokens: int | None = None,
+    ) -> LLMResult:
         log = logging.getLogger("kb.llm")
         if not self.api_key:
             log.warning("DEEPSEEK_API_KEY missing, using fallback")
             return LLMResult(content=self._fallback(user_prompt))
+        key = cache_key(model, system_prompt, user_prompt, temperature, max_tokens)
+        cached = self._cache.get(key) if self._cache is not None else None
+        if cached is not None:
+            log.debug("LLM response cache hit")
+            return LLMResult(content=jsonio.loads(cached))
         try:
             url = f"{self.base_url}/chat/completions"
             headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
@@ -38,20 +94,32 @@ class LLMClient:
                     {"role": "user", "content": user_prompt},
                 ],
                 "response_format": {"type": "json_object"},
-                "temperature": 0.1,
+                "temperature": temperature,
             }
+            if max_tokens:
+                payload["max_tokens"] = max_tokens
             # Safe request logging
             log.info("LLM request: url=%s model=%s base=%s", url, model, self.base_url)
             log.debug("LLM headers: %s", {"Authorization": "Bearer ***", "Content-Type": headers.get("Content-Type")})
             log.debug("LLM payload keys: %s", list(payload.keys()))
-            resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=60)
-            if not resp.ok:
+            with self._slots:
+                resp = self._post(url, headers, jsonio.dumps(payload))
+            if resp.status_code >= 400:
                 body_preview = (resp.text or "")[:500]
                 log.error("LLM HTTP %s: %s", resp.status_code, body_preview)
                 resp.raise_for_status()
-            data = resp.json()
+            data = jsonio.loads(resp.content)
+            usage = data.get("usage") or {}
+            if "prompt_cache_hit_tokens" in usage:
+                log.info(
+                    "LLM prompt cache: hit=%s miss=%s",
+                    usage.get("prompt_cache_hit_tokens"),
+                    usage.get("prompt_cache_miss_tokens"),
+                )
             text = data["choices"][0]["message"]["content"]
-            result = json.loads(text)
+            result = jsonio.loads(text)
+            if self._cache is not None:
+                self._cache.put(key, text)
             # Log shape safely for dict or list
             if isinstance(result, dict):
                 log.debug("LLM response JSON keys: %s", list(result.keys()))
@@ -71,7 +139,7 @@ class LLMClient:
         url = LLMClient._extract_first_url(user_prompt)
         form = "link" if url else "text"
         title_src = user_prompt.strip().splitlines()[0] if user_prompt.strip() else "Без названия"
-        title = (re.sub(r"\s+", " ", title_src))[:80]
+        title = _WS_RE.sub(" ", title_src)[:80]
         return {
             "type": default_type,
             "title": title or "Без названия",
@@ -82,9 +150,12 @@ class LLMClient:
 
     @staticmethod
     def _extract_first_url(text: str) -> str:
-        for token in text.split():
-            if token.startswith("http://") or token.startswith("https://"):
-                return token
-        return ""
+        m = _URL_RE.search(text)
+        return m.group(0) if m else ""
 
 
+@lru_cache(maxsize=1)
+def get_llm() -> LLMClient:
+    """Process-wide client built from the app config (shares its connection pool)."""
+    cfg = load_config()
+    return LLMClient(cfg.deepseek_api_key, cfg.deepseek_base_url)
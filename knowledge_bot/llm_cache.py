@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+from .config import load_config
+
+
+def cache_key(model: str, system_prompt: str, user_prompt: str, temperature: float, max_tokens: int | None) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for part in (model, str(temperature), str(max_tokens or ""), system_prompt, user_prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class LLMCache:
+    """Exact-match cache of raw JSON completions, keyed by the full request.
+
+    Raw response text is stored (not the parsed object) so callers that mutate
+    the result never see each other's changes. With ``path`` set, entries are
+    also kept in SQLite so reruns of the CLI tools and bot restarts reuse them.
+    """
+
+    def __init__(self, maxsize: int = 1024, path: Path | None = None):
+        self._maxsize = maxsize
+        self._items: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = self._open(path) if path else None
+
+    @staticmethod
+    def _open(path: Path) -> sqlite3.Connection | None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # One connection shared by worker threads; every use is under self._lock
+            db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, ts INTEGER NOT NULL)"
+            )
+            return db
+        except (OSError, sqlite3.Error) as e:
+            logging.getLogger("kb.llm").warning("LLM disk cache disabled (%s): %s", path, e)
+            return None
+
+    def _remember(self, key: str, text: str) -> None:
+        self._items[key] = text
+        self._items.move_to_end(key)
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            text = self._items.get(key)
+            if text is not None:
+                self._items.move_to_end(key)
+                return text
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error:
+                return None
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key: str, text: str) -> None:
+        with self._lock:
+            self._remember(key, text)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, ts) VALUES (?, ?, ?)",
+                    (key, text, int(time.time())),
+                )
+            except sqlite3.Error as e:
+                logging.getLogger("kb.llm").warning("LLM disk cache write failed: %s", e)
+
+
+@lru_cache(maxsize=1)
+def shared_cache() -> LLMCache | None:
+    # Process-wide, so short-lived LLMClient instances still share hits
+    if os.environ.get("LLM_CACHE_DISABLED", "").strip().lower() in ("1", "true", "yes"):
+        return None
+    return LLMCache(path=load_config().cache_dir / "llm_cache.db")
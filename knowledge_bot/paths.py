@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from datetime import datetime
 from pathlib import Path
 
@@ -7,9 +8,25 @@ from .config import load_config
 from .settings import load_types_config
 
 
+# Directories already created by this process; saves into the same month folder skip the mkdir syscalls
+_ENSURED: set[Path] = set()
+
+
+def _ensure(path: Path, refresh: bool = False) -> Path:
+    if refresh or path not in _ENSURED:
+        path.mkdir(parents=True, exist_ok=True)
+        _ENSURED.add(path)
+    return path
+
+
+def ensure_parent(path: Path) -> None:
+    """Recreate the directory of ``path`` even if this process created it before (it may have been deleted since)."""
+    _ensure(path.parent, refresh=True)
+
+
 def ensure_dirs(root: Path, *subdirs: str) -> None:
     for sub in subdirs:
-        (root / sub).mkdir(parents=True, exist_ok=True)
+        _ensure(root / sub)
 
 
 def now_parts() -> tuple[str, str]:
@@ -19,24 +36,28 @@ def now_parts() -> tuple[str, str]:
 
 def build_export_path(export_root: Path, original_name: str, hash8: str) -> Path:
     year, month = now_parts()
-    target_dir = export_root / year / month
-    target_dir.mkdir(parents=True, exist_ok=True)
+    target_dir = _ensure(export_root / year / month)
     return target_dir / f"{hash8}_{original_name}"
 
 
 def build_attachments_path(attachments_root: Path, original_name: str, hash8: str) -> Path:
     year, month = now_parts()
-    target_dir = attachments_root / year / month
-    target_dir.mkdir(parents=True, exist_ok=True)
+    target_dir = _ensure(attachments_root / year / month)
     return target_dir / f"{hash8}_{original_name}"
 
 
+def vault_relative(vault_root: Path, path: Path) -> Path | None:
+    # Prefix check instead of relative_to + ValueError: Export may live outside the vault
+    root = str(vault_root).rstrip(os.sep) + os.sep
+    p = str(path)
+    return Path(p[len(root):]) if p.startswith(root) else None
+
+
 def target_note_path(vault_root: Path, type_name: str, slug: str) -> Path:
     cfg = load_config()
     types_cfg = load_types_config(cfg.agent_config_path)
     folder = types_cfg.dir_for(type_name)
-    base = vault_root / "700_База_Данных" / folder
-    base.mkdir(parents=True, exist_ok=True)
+    base = _ensure(vault_root / "700_База_Данных" / folder)
     return base / f"{slug}.md"
 
 
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
 import hashlib
+import os
+import tempfile
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable, TypeVar
 
-from .paths import build_export_path, build_attachments_path, target_note_path
+from .paths import build_export_path, build_attachments_path, ensure_parent, target_note_path
+
+T = TypeVar("T")
 from .slugify import make_slug
 
 
@@ -12,6 +16,21 @@ def sha256_8(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()[:8]
 
 
+def sha256_8_file(path: Path) -> str:
+    # Streams through OpenSSL without loading the file into a Python bytes object
+    with path.open("rb") as fh:
+        return hashlib.file_digest(fh, "sha256").hexdigest()[:8]
+
+
+def _with_dir(dst: Path, write: Callable[[], T]) -> T:
+    # Folders are remembered once created; if one was removed from the vault since, recreate and retry once
+    try:
+        return write()
+    except FileNotFoundError:
+        ensure_parent(dst)
+        return write()
+
+
 def choose_unique_note_path(vault_root: Path, type_name: str, slug: str) -> Path:
     p = target_note_path(vault_root, type_name, slug)
     if not p.exists():
@@ -27,18 +46,38 @@ def choose_unique_note_path(vault_root: Path, type_name: str, slug: str) -> Path
 def save_raw_file(export_root: Path, filename: str, content: bytes) -> Path:
     h8 = sha256_8(content)
     dst = build_export_path(export_root, filename, h8)
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    dst.write_bytes(content)
+    _with_dir(dst, lambda: dst.write_bytes(content))
+    return dst
+
+
+def temp_raw_path(export_root: Path) -> Path:
+    # Same filesystem as the final Export location, so the later move is a rename
+    export_root.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=export_root, prefix=".dl-", suffix=".part")
+    os.close(fd)
+    return Path(name)
+
+
+def move_raw_file(export_root: Path, filename: str, src: Path) -> Path:
+    h8 = sha256_8_file(src)
+    dst = build_export_path(export_root, filename, h8)
+    _with_dir(dst, lambda: os.replace(src, dst))
     return dst
 
 
 def save_attachments(attachments_root: Path, files: Iterable[tuple[str, bytes]]) -> list[Path]:
     saved: list[Path] = []
+    # Same buffer under several names is hashed once; the buffer is held so its id stays unique
+    digests: dict[int, tuple[bytes, str]] = {}
+    written: set[Path] = set()
     for name, content in files:
-        h8 = sha256_8(content)
-        dst = build_attachments_path(attachments_root, name, h8)
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        dst.write_bytes(content)
+        known = digests.get(id(content))
+        if known is None:
+            known = digests[id(content)] = (content, sha256_8(content))
+        dst = build_attachments_path(attachments_root, name, known[1])
+        if dst not in written:
+            _with_dir(dst, lambda: dst.write_bytes(content))
+            written.add(dst)
         saved.append(dst)
     return saved
 
@@ -46,7 +85,8 @@ def save_attachments(attachments_root: Path, files: Iterable[tuple[str, bytes]])
 def write_note(vault_root: Path, type_name: str, title: str, rendered: str) -> Path:
     base_slug = make_slug(title)
     note_path = choose_unique_note_path(vault_root, type_name, base_slug)
-    note_path.write_text(rendered, encoding="utf-8")
+    data = rendered.encode("utf-8")
+    _with_dir(note_path, lambda: note_path.write_bytes(data))
     return note_path
 
 
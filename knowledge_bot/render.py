@@ -1,86 +1,127 @@
 from __future__ import annotations
 
+import logging
+import os
+import re
 from datetime import date
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, select_autoescape
 from .config import load_config
 from .settings import load_types_config
 
 
+# Notes are Markdown: autoescape off for every extension
+_AUTOESCAPE = select_autoescape([])
+_IMG_EXTS = frozenset({".png", ".jpg", ".jpeg", ".webp", ".gif"})
+_RAW_FILES_LINE_RE = re.compile(r"^[ \t]*- Исходные файлы:[^\r\n]*(?:\r?\n|\Z)", re.MULTILINE)
+
+
+@lru_cache(maxsize=None)
+def template_environment(templates_dir: Path) -> Environment:
+    # One Environment per templates dir keeps Jinja's compiled-template cache warm;
+    # the bytecode cache also spares new processes the template compile
+    bytecode_cache = None
+    try:
+        bytecode_dir = load_config().cache_dir / "jinja"
+        bytecode_dir.mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(bytecode_dir))
+    except OSError as e:
+        logging.getLogger("kb.render").warning("jinja bytecode cache disabled: %s", e)
+    return Environment(
+        loader=FileSystemLoader(str(templates_dir)),
+        autoescape=_AUTOESCAPE,
+        bytecode_cache=bytecode_cache,
+        # No per-lookup uptodate checks; _template revalidates note templates by mtime/size
+        auto_reload=False,
+        cache_size=400,
+    )
+
+
+@lru_cache(maxsize=128)
+def _template(templates_dir: Path, template_name: str, stamp: tuple[int, int] | None) -> Template:
+    # Compiled once per (dir, name, file stamp): an edited template gets a new key, the
+    # same revalidation schema.allowed_fields_for_type uses, so fields and body stay in sync.
+    # loader.load bypasses the environment's own cache, which would keep serving the old body.
+    env = template_environment(templates_dir)
+    return env.loader.load(env, template_name, env.globals)
+
+
+def _template_stamp(path: Path) -> tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None  # the loader raises TemplateNotFound
+    return st.st_mtime_ns, st.st_size
+
+
 def render_note(templates_dir: Path, payload: dict[str, Any]) -> str:
-    env = Environment(loader=FileSystemLoader(str(templates_dir)), autoescape=select_autoescape([]))
     type_name = payload.get("type", "знание")
     cfg = load_config()
     types_cfg = load_types_config(cfg.agent_config_path)
     template_name = types_cfg.template_for(type_name)
-    template = env.get_template(template_name)
-    data = {**payload}
-    data.setdefault("created", date.today().isoformat())
-    data.setdefault("raw_dir", payload.get("raw_dir", ""))
+    template = _template(templates_dir, template_name, _template_stamp(templates_dir / template_name))
+    # Defaults go in as render() kwargs: the payload itself is never copied or mutated here
+    extras: dict[str, Any] = {}
+    if "created" not in payload:
+        extras["created"] = date.today().isoformat()
+    if "raw_dir" not in payload:
+        extras["raw_dir"] = ""
     # Provide safe defaults for nested structures expected by templates
-    if data.get("type") == "контакт":
-        handles = data.get("handles") or {}
-        handles.setdefault("tg", "")
-        handles.setdefault("email", "")
-        handles.setdefault("phone", "")
-        data["handles"] = handles
-    content = template.render(**data)
+    if type_name == "контакт":
+        extras["handles"] = {"tg": "", "email": "", "phone": "", **(payload.get("handles") or {})}
+    # Sections are collected and joined once instead of re-copying the growing note per section
+    parts: list[str] = [template.render(payload, **extras)]
     # Optional images section (embed) and files section (links)
-    att = data.get("attachments") or {}
-    files = [p for p in (att.get("files") or []) if isinstance(p, str) and p.strip()]
-    if files:
-        image_exts = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
-        import os
-        imgs = [p for p in files if os.path.splitext(p)[1].lower() in image_exts]
-        docs = [p for p in files if p not in imgs]
+    att = payload.get("attachments") or {}
+    # Plain notes carry empty lists here: skip the filtering entirely
+    att_files = att.get("files")
+    if att_files:
+        imgs: list[str] = []
+        docs: list[str] = []
+        for p in att_files:
+            if isinstance(p, str) and p.strip():
+                (imgs if os.path.splitext(p)[1].lower() in _IMG_EXTS else docs).append(p)
         if imgs:
-            lines_i = ["\n## Изображения\n"]
+            parts.append("\n\n## Изображения\n")
             for p in imgs:
-                lines_i.append(f"![[{p}]]\n")
-            content = f"{content}\n{''.join(lines_i)}"
+                parts.append(f"![[{p}]]\n")
         if docs:
-            lines_f = ["\n## Файлы\n"]
+            parts.append("\n\n## Файлы\n")
             for p in docs:
                 name = p.split("/")[-1]
-                lines_f.append(f"- [[{p}|{name}]]\n")
-            content = f"{content}\n{''.join(lines_f)}"
+                parts.append(f"- [[{p}|{name}]]\n")
     # Optional links section with anchors and plain links fallback
-    links_anchors = data.get("links_anchors") or []
-    extra_links = []
-    for u in (att.get("links") or []):
-        if isinstance(u, str) and u.strip():
-            extra_links.append(u)
-    if isinstance(links_anchors, list) and (links_anchors or extra_links):
-        lines = ["\n## Ссылки\n"]
-        seen = set()
+    links_anchors = payload.get("links_anchors") or []
+    att_links = att.get("links")
+    if isinstance(links_anchors, list) and (links_anchors or att_links):
+        # url -> rendered item; insertion order is the output order, first occurrence wins
+        link_map: dict[str, str] = {}
         for item in links_anchors:
             url = (item.get("url") if isinstance(item, dict) else None) or ""
             text = (item.get("text") if isinstance(item, dict) else None) or url
-            if text and url and url not in seen:
-                lines.append(f"- [{text}]({url})\n")
-                seen.add(url)
-        for url in extra_links:
-            if url not in seen:
-                lines.append(f"- {url}\n")
-                seen.add(url)
-        if len(lines) > 1:
-            content = f"{content}\n{''.join(lines)}"
-    raw_text = (data.get("raw_text") or "").strip()
+            if text and url and url not in link_map:
+                link_map[url] = f"[{text}]({url})"
+        for url in att_links or ():
+            if isinstance(url, str) and url.strip():
+                link_map.setdefault(url, url)
+        if link_map:
+            parts.append("\n\n## Ссылки\n")
+            parts.extend(f"- {v}\n" for v in link_map.values())
+    raw_text = (payload.get("raw_text") or "").strip()
     if raw_text:
-        content = f"{content}\n\n## Исходный текст\n\n{raw_text}\n"
+        parts.append(f"\n\n## Исходный текст\n\n{raw_text}\n")
     # ASR summary and transcript sections (optional)
-    asr_summary = (data.get("asr_summary") or "").strip()
+    asr_summary = (payload.get("asr_summary") or "").strip()
     if asr_summary:
-        content = f"{content}\n\n## Сводка (ASR)\n\n{asr_summary}\n"
-    asr_text = (data.get("asr_text") or "").strip()
+        parts.append(f"\n\n## Сводка (ASR)\n\n{asr_summary}\n")
+    asr_text = (payload.get("asr_text") or "").strip()
     if asr_text:
-        content = f"{content}\n\n## Транскрипция\n\n{asr_text}\n"
+        parts.append(f"\n\n## Транскрипция\n\n{asr_text}\n")
+    content = "".join(parts)
     # Remove placeholder line for raw_dir (redundant regardless of presence)
-    lines = content.splitlines()
-    lines = [ln for ln in lines if not ln.strip().startswith("- Исходные файлы:")]
-    content = "\n".join(lines)
-    return content
-
-
+    content = _RAW_FILES_LINE_RE.sub("", content)
+    # Same shape as the former splitlines/join: no trailing newline
+    return content[:-1] if content.endswith("\n") else content
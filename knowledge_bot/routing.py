@@ -1,13 +1,28 @@
 from __future__ import annotations
 
-import json
 from datetime import date
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
+from . import jsonio
 from .llm import LLMClient
 from .config import load_config
-from .settings import load_prompt, load_types_config, load_enums_config
+from .settings import EnumsConfig, TypesConfig, load_prompt, load_types_config, load_enums_config
+
+
+# Constant defaults for routed payloads; lists are copied per payload
+_ROUTE_DEFAULTS: tuple[tuple[str, Any], ...] = (("title", "Без названия"), ("tags", []), ("form", "text"))
+
+
+@lru_cache(maxsize=None)
+def _static_route_json(config_dir: Path) -> str:
+    # allowed_types + enums serialized once per config dir, outer braces stripped for splicing
+    static = jsonio.dumps({
+        "allowed_types": load_types_config(config_dir).type_names,
+        "enums": load_enums_config(config_dir).prompt_payload(),
+    })
+    return static[1:-1]
 
 
 def route_and_fill(
@@ -19,54 +34,73 @@ def route_and_fill(
     system_prompt = load_prompt(cfg.agent_config_path, "routing")
     types_cfg = load_types_config(cfg.agent_config_path)
     enums_cfg = load_enums_config(cfg.agent_config_path)
-    allowed_types = list(types_cfg.types.keys())
-    user = json.dumps({
-        "summary": extracted_summary,
-        "source": source_hint,
-        "allowed_types": allowed_types,
-        "enums": {
-            "namespaces_controlled": enums_cfg.namespaces_controlled,
-            "common": enums_cfg.common,
-            "per_type": enums_cfg.per_type,
-        }
-    }, ensure_ascii=False)
+    # Static members first: identical leading bytes across calls hit the provider's prefix cache
+    user = (
+        "{" + _static_route_json(cfg.agent_config_path)
+        + ',"source":' + jsonio.dumps(source_hint)
+        + ',"summary":' + jsonio.dumps(extracted_summary) + "}"
+    )
     result = llm.chat_json(system_prompt, user)
-    payload = result.content or {}
+    return normalize_route(result.content or {}, source_hint, types_cfg, enums_cfg)
+
+
+def normalize_route(
+    payload: dict[str, Any],
+    source_hint: str | None,
+    types_cfg: TypesConfig,
+    enums_cfg: EnumsConfig,
+) -> dict[str, Any]:
+    """Defaults, allowed type, clamped enum fields and filtered tags for a routing reply."""
     # Ensure minimal fields
-    payload.setdefault("type", types_cfg.types.keys().__iter__().__next__() if allowed_types else "знание")
-    payload.setdefault("title", "Без названия")
+    payload.setdefault("type", types_cfg.first_type)
     # Теги: принимаем из LLM, но позже отфильтруем контролируемые по enums
-    payload.setdefault("tags", [])
-    payload.setdefault("attachments", {"links": [], "files": []})
-    payload.setdefault("form", "text")
+    for key, default in _ROUTE_DEFAULTS:
+        if key not in payload:
+            payload[key] = list(default) if isinstance(default, list) else default
+    if "attachments" not in payload:
+        payload["attachments"] = {"links": [], "files": []}
     payload.setdefault("source", source_hint or "")
-    payload.setdefault("created", date.today().isoformat())
+    if "created" not in payload:
+        payload["created"] = date.today().isoformat()
     # Enforce allowed type set
-    if payload.get("type") not in allowed_types:
+    if payload.get("type") not in types_cfg.types:
         payload["type"] = getattr(types_cfg, "default_type", None) or "знание"
     # Validate enumerated fields and tags
     t = payload["type"]
-    per_type_enums = enums_cfg.per_type.get(t, {})
     # clamp fields like status/priority/category if present
-    for field, choices in {**enums_cfg.common, **per_type_enums}.items():
-        if field in payload and isinstance(payload[field], str):
-            val = payload[field]
-            if val not in choices:
-                payload[field] = choices[0] if choices else val
-    # filter tags
-    tags = payload.get("tags") or []
-    filtered = []
-    for tag in tags:
-        if not isinstance(tag, str) or "/" not in tag:
-            continue
-        ns, _, value = tag.partition("/")
-        if ns in enums_cfg.namespaces_controlled:
-            allowed = enums_cfg.common.get(ns) or per_type_enums.get(ns)
-            if allowed and value in allowed:
-                filtered.append(tag)
-        else:
-            filtered.append(tag)
-    payload["tags"] = filtered
+    for field, choices, choice_set in enums_cfg.choices_for(t):
+        val = payload.get(field)
+        if isinstance(val, str) and val not in choice_set and choices:
+            payload[field] = choices[0]
+    # filter tags: one pass, set lookups only
+    payload["tags"] = [
+        tag
+        for tag in payload.get("tags") or []
+        if isinstance(tag, str) and "/" in tag and enums_cfg.allows_tag(t, *tag.split("/", 1))
+    ]
     return payload
 
 
+def reclassify_with_asr(
+    llm: LLMClient,
+    routed: dict[str, Any],
+    asr_summary: str,
+) -> dict[str, Any]:
+    """Type/title overrides once a transcript is known (empty dict keeps the initial route)."""
+    cfg = load_config()
+    system_prompt = load_prompt(cfg.agent_config_path, "route_reclassify_asr")
+    types_cfg = load_types_config(cfg.agent_config_path)
+    user = jsonio.dumps({
+        "allowed_types": types_cfg.type_names,
+        "initial_route": {"type": routed.get("type"), "title": routed.get("title")},
+        "asr_summary": asr_summary,
+    })
+    result = llm.chat_json(system_prompt, user, max_tokens=64).content
+    if not isinstance(result, dict):
+        return {}
+    update: dict[str, Any] = {}
+    if result.get("type") in types_cfg.types:
+        update["type"] = result["type"]
+    if isinstance(result.get("title"), str) and result["title"].strip():
+        update["title"] = result["title"].strip()
+    return update
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
 import re
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Set
+from typing import List
+
+from jinja2 import TemplateSyntaxError, meta
 
 from .config import load_config
+from .render import template_environment
 from .settings import load_types_config
 
 
@@ -12,6 +17,24 @@ VAR_RE = re.compile(r"\{\{\s*([a-zA-Z0-9_\.]+)\s*\}\}")
 
 
 DEFAULT_FIELDS = {"type", "title", "created", "tags", "attachments", "source", "form", "raw_dir"}
+# Set by the bot from the message itself; templates may read them but the LLM must never fill them
+PAYLOAD_INTERNAL_FIELDS = {"raw_text", "asr_text", "asr_summary", "links_anchors", "handles", "filenames"}
+
+_FIELDS_CACHE_MAX = 100
+_FIELDS_CACHE: OrderedDict[Path, tuple[tuple[int, int], tuple[str, ...]]] = OrderedDict()
+_FIELDS_LOCK = threading.Lock()
+
+
+def _scan_fields(templates_dir: Path, text: str) -> tuple[str, ...]:
+    # Jinja's own AST also sees names used only in {% if %}/{% for %} blocks and filters
+    try:
+        names = meta.find_undeclared_variables(template_environment(templates_dir).parse(text))
+    except TemplateSyntaxError:
+        names = set()
+        for m in VAR_RE.finditer(text):
+            # skip nested like attachments.links etc. We only allow top-level known fields plus simple ones
+            names.add(m.group(1).split(".", 1)[0])
+    return tuple(sorted(names - DEFAULT_FIELDS - PAYLOAD_INTERNAL_FIELDS))
 
 
 def allowed_fields_for_type(type_name: str) -> List[str]:
@@ -19,18 +42,21 @@ def allowed_fields_for_type(type_name: str) -> List[str]:
     types_cfg = load_types_config(cfg.agent_config_path)
     template_name = types_cfg.template_for(type_name)
     template_path = cfg.templates_path / template_name
-    if not template_path.exists():
+    try:
+        st = template_path.stat()
+    except OSError:
         return []
-    text = template_path.read_text(encoding="utf-8", errors="ignore")
-    fields: Set[str] = set()
-    for m in VAR_RE.finditer(text):
-        var = m.group(1)
-        # skip nested like attachments.links etc. We only allow top-level known fields plus simple ones
-        if "." in var:
-            var = var.split(".", 1)[0]
-        if var in DEFAULT_FIELDS:
-            continue
-        fields.add(var)
-    return sorted(fields)
-
-
+    # Rescan only when the template file changed (mtime/size), so edits in the vault still apply
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _FIELDS_LOCK:
+        hit = _FIELDS_CACHE.get(template_path)
+        if hit is not None and hit[0] == stamp:
+            _FIELDS_CACHE.move_to_end(template_path)
+            return list(hit[1])
+    fields = _scan_fields(cfg.templates_path, template_path.read_text(encoding="utf-8", errors="ignore"))
+    with _FIELDS_LOCK:
+        _FIELDS_CACHE[template_path] = (stamp, fields)
+        _FIELDS_CACHE.move_to_end(template_path)
+        while len(_FIELDS_CACHE) > _FIELDS_CACHE_MAX:
+            _FIELDS_CACHE.popitem(last=False)
+    return list(fields)
@@ -1,18 +1,59 @@
 from __future__ import annotations
 
+import os
 from dataclasses import dataclass
 from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as _YamlLoader
+
+from . import jsonio
+from .slugify import slug_ascii
+
+
+def load_yaml_cached(path: Path) -> Any:
+    """yaml.safe_load of ``path``, reusing a JSON copy of the parse while the file is unchanged."""
+    st = path.stat()
+    stamp = [st.st_mtime_ns, st.st_size]
+    sidecar = path.with_name(path.name + ".cache.json")
+    try:
+        cached = jsonio.loads(sidecar.read_bytes())
+        if cached.get("stamp") == stamp:
+            return cached["data"]
+    except Exception:
+        pass  # missing or unreadable cache: parse the YAML
+    data = yaml.load(path.read_text(encoding="utf-8"), Loader=_YamlLoader)
+    try:
+        text = jsonio.dumps({"stamp": stamp, "data": data})
+    except TypeError:
+        return data  # e.g. YAML dates: not JSON-serializable, parse every time
+    # Only cache what JSON round-trips exactly (int keys would come back as strings)
+    if jsonio.loads(text)["data"] == data:
+        tmp = sidecar.with_name(f".{sidecar.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(text, encoding="utf-8")
+            os.replace(tmp, sidecar)
+        except OSError:
+            tmp.unlink(missing_ok=True)  # read-only config dir: just skip the cache
+    return data
+
 
 @dataclass
 class TypesConfig:
     default_template: str
     types: dict[str, dict[str, str]]
 
+    def __post_init__(self) -> None:
+        # Derived once per config load; routing reads these on every call
+        self.type_names: list[str] = list(self.types)
+        self.first_type: str = next(iter(self.types), "знание")
+
     def dir_for(self, type_name: str) -> str:
         entry = self.types.get(type_name)
         return entry.get("dir") if entry else "Знания"
@@ -22,16 +63,17 @@ class TypesConfig:
         return (entry.get("template") if entry else None) or self.default_template
 
 
-@lru_cache(maxsize=1)
+@lru_cache(maxsize=None)
 def load_types_config(config_dir: Path) -> TypesConfig:
     cfg_path = config_dir / "types.yaml"
-    data = yaml.safe_load(cfg_path.read_text(encoding="utf-8"))
+    data = load_yaml_cached(cfg_path)
     return TypesConfig(
         default_template=data.get("default_template", "Знание.j2.md"),
         types=data.get("types", {}),
     )
 
 
+@lru_cache(maxsize=None)
 def load_prompt(config_dir: Path, name: str) -> str:
     p = config_dir / "prompts" / f"{name}.txt"
     return p.read_text(encoding="utf-8")
@@ -39,18 +81,69 @@ def load_prompt(config_dir: Path, name: str) -> str:
 
 @dataclass
 class EnumsConfig:
-    namespaces_controlled: list[str]
+    namespaces_controlled: frozenset[str]
     common: dict[str, list[str]]
     per_type: dict[str, dict[str, list[str]]]
     synonyms: dict[str, dict[str, str]]
 
-
-@lru_cache(maxsize=1)
+    def prompt_payload(self) -> dict[str, Any]:
+        # The "enums" block sent to routing/field_fill/tags prompts
+        return {
+            "namespaces_controlled": self.namespaces_sorted,
+            "common": self.common,
+            "per_type": self.per_type,
+        }
+
+    def __post_init__(self) -> None:
+        # Tag lookups keyed by (type or None for common, namespace); common wins over per_type
+        self.namespaces_controlled = frozenset(self.namespaces_controlled)
+        # Stable order for prompts (sets have none), so the serialized enums block stays byte-identical
+        self.namespaces_sorted: list[str] = sorted(self.namespaces_controlled)
+        self.slug_index: dict[tuple[Optional[str], str], dict[str, Any]] = {}
+        self.allowed_sets: dict[tuple[Optional[str], str], frozenset] = {}
+        scopes = [(None, self.common)] + [(t, block or {}) for t, block in self.per_type.items()]
+        for type_name, block in scopes:
+            for ns, values in block.items():
+                values = values or []
+                index: dict[str, Any] = {}
+                for value in values:
+                    index.setdefault(slug_ascii(str(value)), value)
+                self.slug_index[(type_name, ns)] = index
+                self.allowed_sets[(type_name, ns)] = frozenset(values)
+        # Field clamping merges the other way round (per_type overrides common); None = common only
+        self.field_choices: dict[Optional[str], tuple[tuple[str, list, frozenset], ...]] = {}
+        for type_name in [None, *self.per_type]:
+            merged = {**self.common, **((self.per_type.get(type_name) or {}) if type_name else {})}
+            self.field_choices[type_name] = tuple(
+                (field, list(choices or []), frozenset(choices or [])) for field, choices in merged.items()
+            )
+
+    def _scope(self, type_name: Optional[str], ns: str) -> tuple[Optional[str], str]:
+        return (None, ns) if self.common.get(ns) else (type_name, ns)
+
+    def allowed_values(self, type_name: Optional[str], ns: str) -> frozenset:
+        return self.allowed_sets.get(self._scope(type_name, ns), frozenset())
+
+    def canonical_value(self, type_name: Optional[str], ns: str, slug: str) -> Any:
+        """Allowed value of ``ns`` whose slug equals ``slug``, or None."""
+        return self.slug_index.get(self._scope(type_name, ns), {}).get(slug)
+
+    def choices_for(self, type_name: Optional[str]) -> tuple[tuple[str, list, frozenset], ...]:
+        """(field, ordered choices, choice set) for every enumerated field of ``type_name``."""
+        return self.field_choices.get(type_name) or self.field_choices[None]
+
+    def allows_tag(self, type_name: Optional[str], ns: str, value: str) -> bool:
+        if ns not in self.namespaces_controlled:
+            return True
+        return value in self.allowed_values(type_name, ns)
+
+
+@lru_cache(maxsize=None)
 def load_enums_config(config_dir: Path) -> EnumsConfig:
     p = config_dir / "enums.yaml"
-    data = yaml.safe_load(p.read_text(encoding="utf-8")) if p.exists() else {}
+    data = (load_yaml_cached(p) or {}) if p.exists() else {}
     return EnumsConfig(
-        namespaces_controlled=data.get("namespaces", {}).get("controlled", []),
+        namespaces_controlled=frozenset(data.get("namespaces", {}).get("controlled", []) or []),
         common=data.get("common", {}),
         per_type=data.get("per_type", {}),
         synonyms=data.get("synonyms", {}) or data.get("aliases", {}),
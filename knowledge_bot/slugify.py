@@ -2,12 +2,32 @@ import re
 
 
 _ALLOWED = re.compile(r"[^\w\s-]", re.UNICODE)
+_WS_RUN = re.compile(r"\s+")
+
+_TRANSLIT_TABLE = str.maketrans({
+    "а":"a","б":"b","в":"v","г":"g","д":"d","е":"e","ё":"e","ж":"zh","з":"z","и":"i","й":"i",
+    "к":"k","л":"l","м":"m","н":"n","о":"o","п":"p","р":"r","с":"s","т":"t","у":"u","ф":"f",
+    "х":"h","ц":"c","ч":"ch","ш":"sh","щ":"shch","ы":"y","э":"e","ю":"yu","я":"ya",
+    "А":"a","Б":"b","В":"v","Г":"g","Д":"d","Е":"e","Ё":"e","Ж":"zh","З":"z","И":"i","Й":"i",
+    "К":"k","Л":"l","М":"m","Н":"n","О":"o","П":"p","Р":"r","С":"s","Т":"t","У":"u","Ф":"f",
+    "Х":"h","Ц":"c","Ч":"ch","Ш":"sh","Щ":"shch","Ы":"y","Э":"e","Ю":"yu","Я":"ya",
+})
+_SLUG_STRIP = re.compile(r"[^a-z0-9\-/]")
+_SLUG_COLLAPSE = re.compile(r"-+")
 
 
 def make_slug(title: str) -> str:
     s = title.strip()
     s = _ALLOWED.sub("", s)
-    s = re.sub(r"\s+", "_", s)
+    s = _WS_RUN.sub("_", s)
     return s if s else "note"
 
 
+def translit_ru(s: str) -> str:
+    return s.translate(_TRANSLIT_TABLE)
+
+
+def slug_ascii(s: str) -> str:
+    """ASCII tag slug: transliterated, lower-case, dash-separated."""
+    s = translit_ru(s).lower().replace(" ", "-").replace("_", "-")
+    return _SLUG_COLLAPSE.sub("-", _SLUG_STRIP.sub("", s)).strip("-")